@@ -0,0 +1,200 @@
+'''
+Benchmarks for the slow parts of the pipeline
+
+Usage:
+    python bench.py backends <folder with PDFs>
+    python bench.py text <folder with PDFs>
+    python bench.py memory [number of pages]
+    python bench.py llm [number of documents] [latency in seconds]
+'''
+
+import re
+import sys
+import time
+import random
+import tempfile
+from pathlib import Path
+
+from loguru import logger
+import pdfplumber
+
+from readers import PDF, clean_text, text2paragraphs, fix_bullet_list
+from utils import get_rss_mb
+from llm import LLM, RateLimiter
+from cache import AnswerCache
+
+
+def bench_backends(pdf_fns: list[Path], detect_tables=True):
+    '''Compare runtime and paragraph output of the pdfplumber and pymupdf backends'''
+
+    totals = {'pdfplumber': 0.0, 'pymupdf': 0.0}
+    print(f'{"file":<40} {"backend":<12} {"time":>8} {"paras":>6} {"tables":>6}')
+
+    for pdf_fn in pdf_fns:
+        words = {}
+        for backend in totals:
+            pdf = PDF(pdf_fn)
+            start = time.perf_counter()
+            paras = list(pdf.yield_paragraphs(detect_tables=detect_tables, backend=backend))
+            elapsed = time.perf_counter() - start
+            totals[backend] += elapsed
+            print(f'{pdf_fn.name[:40]:<40} {backend:<12} {elapsed:8.3f} {pdf.num_paragraphs:6} {pdf.num_tables:6}')
+            # Paragraph boundaries can differ between backends, so compare the stream of words
+            words[backend] = ' '.join(para.text for para in paras if not para.is_table).split()
+
+        same = words['pdfplumber'] == words['pymupdf']
+        print(f'{"":<40} {"same words":<12} {str(same):>8}')
+
+    speedup = totals['pdfplumber'] / max(totals['pymupdf'], 1e-9)
+    print(f'Total: pdfplumber={totals["pdfplumber"]:.2f}s pymupdf={totals["pymupdf"]:.2f}s (speedup {speedup:.1f}x)')
+
+
+# Text normalization as it was before precompiling the patterns (kept as the "before" baseline)
+def legacy_clean_text(text: str) -> str:
+    text = text.replace(u'\u201f', '"')
+    text = text.replace(u'\u201c', '"')
+    text = text.replace(u'\u201d', '"')
+    text = text.replace(u'’', "'")
+    text = re.sub(r'(\(cid:\d+\)){2,}', "", text)
+    text = re.sub(r'\s\(cid:\d+\) ', "- ", text)
+    return text
+
+
+def legacy_text2paragraphs(text: str) -> list[str]:
+    paras = []
+    lines = [legacy_fix_line(line) for line in text.split('\n')] + ['']
+    parts = []
+    for line in lines:
+        if not line and parts:
+            new_para = ' '.join(parts)
+            if '\uf0b7' in new_para:
+                new_para = fix_bullet_list(new_para)
+            paras.append(new_para)
+            parts = []
+        elif line:
+            parts.append(line)
+    if paras and paras[-1].isdigit():
+        paras = paras[:-1]
+    return paras
+
+
+def legacy_fix_line(text: str) -> str:
+    text = text.strip()
+    text = re.sub(r'\s{2,}', ' ', text)
+    text = text.replace('”', '"').replace('“', '"')
+    return text
+
+
+def bench_text(pdf_fns: list[Path], repeat=20):
+    '''Per-page throughput of the text normalization (clean_text + text2paragraphs), before and after'''
+
+    # Extract the layout text once; we only want to time the normalization
+    texts = []
+    for pdf_fn in pdf_fns:
+        with pdfplumber.open(pdf_fn) as pdf:
+            texts.extend(page.extract_text(layout=True, y_density=13.8) for page in pdf.pages[:50])
+
+    pipelines = {
+        'before': lambda text: legacy_text2paragraphs(legacy_clean_text(text)),
+        'after': lambda text: list(text2paragraphs(clean_text(text))),
+    }
+    outputs = {}
+    for name, pipeline in pipelines.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs[name] = [pipeline(text) for text in texts]
+        elapsed = time.perf_counter() - start
+        print(f'{name:<8} {repeat * len(texts) / elapsed:10.0f} pages/s')
+
+    print(f'Same paragraphs: {outputs["before"] == outputs["after"]} ({len(texts)} pages)')
+
+
+def make_synthetic_pdf(filename: Path, num_pages: int, lines_per_page=45, seed=0):
+    '''Write a text-only PDF (Helvetica, one content stream per page) without any PDF library'''
+    rng = random.Random(seed)
+    words = 'the card account interest rate purchase balance fee payment credit limit gambling transactions'.split()
+
+    # Objects: 1=catalog, 2=pages, 3=font, then (page, content) pairs
+    objects = {1: b'<< /Type /Catalog /Pages 2 0 R >>', 3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'}
+    kids = []
+    for i in range(num_pages):
+        page_id, content_id = 4 + 2 * i, 5 + 2 * i
+        lines = [' '.join(rng.choice(words) for _ in range(12)) for _ in range(lines_per_page)]
+        lines[::8] = [''] * len(lines[::8]) # paragraph breaks
+        stream = 'BT /F1 10 Tf 14 TL 72 740 Td ' + ' '.join(f'({line}) Tj T*' for line in lines) + ' ET'
+        stream = stream.encode('latin-1')
+        objects[content_id] = b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream'
+        objects[page_id] = (b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % content_id)
+        kids.append(b'%d 0 R' % page_id)
+    objects[2] = b'<< /Type /Pages /Kids [' + b' '.join(kids) + b'] /Count %d >>' % num_pages
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = len(out)
+        out += b'%d 0 obj\n' % obj_id + objects[obj_id] + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offsets[obj_id] for obj_id in sorted(objects))
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    filename.write_bytes(bytes(out))
+
+
+def bench_memory(num_pages=1000, max_memory_mb=None, report_every=100):
+    '''RSS while streaming all pages of a synthetic PDF'''
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_fn = Path(tmp) / 'synthetic.pdf'
+        make_synthetic_pdf(pdf_fn, num_pages)
+        pdf = PDF(pdf_fn)
+        start = time.perf_counter()
+        print(f'max_memory_mb={max_memory_mb}; RSS at start: {get_rss_mb():.0f}MB')
+        prev_page = 0
+        for para in pdf.yield_paragraphs(max_pages=None, max_memory_mb=max_memory_mb):
+            if para.page != prev_page and para.page % report_every == 0:
+                print(f'  page {para.page:5}: RSS {get_rss_mb():.0f}MB')
+            prev_page = para.page
+        print(f'  done: RSS {get_rss_mb():.0f}MB; {pdf.num_paragraphs} paragraphs in {time.perf_counter() - start:.1f}s')
+
+
+def bench_llm(num_docs=500, latency=0.8, max_concurrency=16, rpm=3_000, tpm=2_000_000):
+    '''Throughput of LLM.find_answers() against replay clients (no network), with errors, retries and caching'''
+    from replay import replay_clients # Only needed here
+    rng = random.Random(0)
+    words = 'the card account interest rate purchase balance fee payment credit limit gambling transactions'.split()
+    contexts = [' '.join(rng.choice(words) for _ in range(rng.randint(500, 3000))) for _ in range(num_docs)]
+    requests = [dict(question='Q: ', context=context) for context in contexts]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = AnswerCache(Path(tmp) / 'answers.sqlite')
+        clients = replay_clients(latency=latency, latency_sigma=0.5, error_rates={'rate_limit': 0.03, 'server_error': 0.01, 'timeout': 0.005})
+        llm = LLM(cache=cache, rate_limiter=RateLimiter(rpm, tpm), max_concurrency=max_concurrency, **clients)
+
+        for run in ('cold', 'warm'):
+            start = time.perf_counter()
+            answers = llm.find_answers(requests)
+            elapsed = time.perf_counter() - start
+            sources = {source: sum(ans['source'] == source for ans in answers) for source in ('llm', 'cache', 'error')}
+            print(f'{run:<6} {num_docs / elapsed:8.1f} docs/s ({elapsed:.1f}s); {sources}')
+        print(f'Replay: {clients["client"].stats}; cache: {cache.stats}')
+        cache.close()
+
+
+if __name__ == '__main__':
+    logger.remove()
+    benchmark = sys.argv[1]
+
+    if benchmark == 'backends':
+        bench_backends(sorted(Path(sys.argv[2]).glob('**/*.pdf')))
+    elif benchmark == 'text':
+        bench_text(sorted(Path(sys.argv[2]).glob('**/*.pdf')))
+    elif benchmark == 'memory':
+        num_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        bench_memory(num_pages)
+        bench_memory(num_pages, max_memory_mb=200)
+    elif benchmark == 'llm':
+        num_docs = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.8
+        bench_llm(num_docs, latency)
+    else:
+        exit(f'Error: unknown benchmark "{benchmark}"')
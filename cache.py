@@ -0,0 +1,196 @@
+'''
+Answer cache for the LLM: a key -> JSON dict store in SQLite
+
+- WAL mode, so readers don't block the writer (and several processes can share a file)
+- Writes are buffered and committed in groups (every `commit_every` answers or `commit_interval` seconds)
+- Values are zlib-compressed JSON
+- Optional eviction of the oldest entries (max_entries) or of entries older than max_age seconds
+- Thread-safe (one connection guarded by a lock)
+
+Old per-period SqliteDict caches can be loaded with import_sqlitedict()
+'''
+
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+from sqlitedict import SqliteDict
+
+
+class AnswerCache:
+
+    def __init__(
+            self,
+            filename: Path,
+            commit_every: int = 100,
+            commit_interval: float = 5.0,
+            max_entries: Optional[int] = None,
+            max_age: Optional[float] = None,
+            compress_level: int = 6
+        ):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.compress_level = compress_level
+
+        self.pending = {} # key -> (compressed value, timestamp); not yet written
+        self.last_commit = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = threading.RLock()
+
+        logger.info(f'Connecting to answer cache "{self.filename}"')
+        self.conn = sqlite3.connect(str(self.filename), timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL') # With WAL, a crash can lose the last commits but not corrupt the file
+        self.conn.execute('CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, value BLOB, created REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_created ON answers (created)')
+        self.conn.commit()
+        self.evict()
+
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.get_first([key])[1]
+
+
+    def get_first(self, keys: list[str]) -> tuple[Optional[str], Optional[dict]]:
+        '''Value of the first key found, and that key; the lookup counts as one hit or miss, however many keys are tried'''
+        with self.lock:
+            data = None
+            for key in keys:
+                data = self._load(key)
+                if data is not None:
+                    break
+
+            if data is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+            self.bytes_read += len(data)
+        return key, json.loads(zlib.decompress(data))
+
+
+    def _load(self, key: str) -> Optional[bytes]:
+        # Call with the lock held
+        if key in self.pending:
+            return self.pending[key][0]
+        row = self.conn.execute('SELECT value, created FROM answers WHERE key=?', (key,)).fetchone()
+        if row is not None and self.max_age is not None and row[1] < time.time() - self.max_age:
+            row = None # Expired (will be deleted on the next eviction)
+        return None if row is None else row[0]
+
+
+    def put(self, key: str, value: dict):
+        data = zlib.compress(json.dumps(value).encode('utf-8'), self.compress_level)
+        with self.lock:
+            self.pending[key] = (data, time.time())
+            self.bytes_written += len(data)
+            if len(self.pending) >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+                self.commit()
+
+
+    def __contains__(self, key: str) -> bool:
+        # Doesn't count as a hit or miss
+        with self.lock:
+            if key in self.pending:
+                return True
+            return self.conn.execute('SELECT 1 FROM answers WHERE key=?', (key,)).fetchone() is not None
+
+
+    def __getitem__(self, key: str) -> dict:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+    def __setitem__(self, key: str, value: dict):
+        self.put(key, value)
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            self.commit()
+            return self.conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+
+
+    def commit(self):
+        with self.lock:
+            if self.pending:
+                rows = [(key, data, created) for key, (data, created) in self.pending.items()]
+                self.conn.executemany('INSERT OR REPLACE INTO answers VALUES (?, ?, ?)', rows)
+                self.conn.commit()
+                self.pending = {}
+                if self.max_entries is not None:
+                    self.evict()
+            self.last_commit = time.monotonic()
+
+
+    def evict(self) -> int:
+        '''Delete expired entries and, above max_entries, the oldest ones; returns the number of deleted entries'''
+        with self.lock:
+            num_deleted = 0
+            if self.max_age is not None:
+                cursor = self.conn.execute('DELETE FROM answers WHERE created < ?', (time.time() - self.max_age,))
+                num_deleted += cursor.rowcount
+            if self.max_entries is not None:
+                cursor = self.conn.execute('''DELETE FROM answers WHERE key IN (
+                    SELECT key FROM answers ORDER BY created DESC LIMIT -1 OFFSET ?)''', (self.max_entries,))
+                num_deleted += cursor.rowcount
+            self.conn.commit()
+        if num_deleted:
+            logger.info(f'Evicted {num_deleted} entries from answer cache "{self.filename}"')
+        return num_deleted
+
+
+    def import_sqlitedict(self, filename: Path) -> int:
+        '''Copy the entries of an old SqliteDict cache (existing keys are kept); returns the number of new entries'''
+        num_imported = 0
+        db = SqliteDict(str(filename), flag='r')
+        try:
+            with self.lock:
+                for key, value in db.items():
+                    if key not in self:
+                        self.put(key, value)
+                        num_imported += 1
+                self.commit()
+        finally:
+            db.close()
+        logger.info(f'Imported {num_imported} answers from "{filename}"')
+        return num_imported
+
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+            }
+
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,130 @@
+'''
+Paragraph corpus: every paragraph of every document, one row per paragraph
+
+Stored in SQLite (default) or Parquet (if the filename ends in .parquet; requires pyarrow),
+so later analyses and prompt experiments can scan paragraphs instead of parsing the PDFs again
+
+Columns: period, bank_name, filename, page, is_table, position, text
+
+Documents must be added whole: main.process_periods() only fills the corpus when it parses without
+page/token limits; export_period() parses every page of every PDF
+'''
+
+import sqlite3
+from pathlib import Path
+from typing import Optional
+from collections.abc import Iterable
+
+import pandas as pd
+from loguru import logger
+
+from readers import Para, yield_documents
+
+# Optional; only needed for Parquet corpora
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+COLUMNS = ['period', 'bank_name', 'filename', 'page', 'is_table', 'position', 'text']
+
+
+class Corpus:
+    '''Append-only writer; rows are buffered and written in batches'''
+
+    def __init__(self, filename: Path, batch_size: int = 10_000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.rows = []
+        self.use_parquet = filename.suffix.lower() == '.parquet'
+        logger.info(f'Writing paragraphs to corpus "{self.filename}"')
+
+        if self.use_parquet:
+            assert pa is not None, 'pyarrow is not installed'
+            self.schema = pa.schema([
+                ('period', pa.string()), ('bank_name', pa.string()), ('filename', pa.string()), ('page', pa.int32()),
+                ('is_table', pa.bool_()), ('position', pa.int32()), ('text', pa.string())])
+            # Note: Parquet files can't be appended to, so this overwrites any existing file
+            self.writer = pq.ParquetWriter(str(self.filename), self.schema)
+        else:
+            self.conn = sqlite3.connect(str(self.filename))
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS paragraphs (
+                period TEXT, bank_name TEXT, filename TEXT, page INTEGER, is_table INTEGER, position INTEGER, text TEXT)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_document ON paragraphs (period, bank_name, filename)')
+
+
+    def add_document(self, period: str, bank_name: str, filename: str, paras: Iterable[Para]):
+        if not self.use_parquet:
+            # Reruns replace the rows of a document instead of duplicating them
+            self.flush()
+            self.conn.execute('DELETE FROM paragraphs WHERE period=? AND bank_name=? AND filename=?', (period, bank_name, filename))
+
+        for i, para in enumerate(paras):
+            position = i if para.position is None else para.position
+            self.rows.append((period, bank_name, filename, para.page, para.is_table, position, para.text))
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+
+    def flush(self):
+        if self.use_parquet:
+            if self.rows:
+                columns = list(zip(*self.rows))
+                table = pa.table({name: list(col) for name, col in zip(COLUMNS, columns)}, schema=self.schema)
+                self.writer.write_table(table)
+        else:
+            if self.rows:
+                self.conn.executemany(f'INSERT INTO paragraphs VALUES ({",".join("?" * len(COLUMNS))})', self.rows)
+            self.conn.commit()
+        self.rows = []
+
+
+    def close(self):
+        self.flush()
+        if self.use_parquet:
+            self.writer.close()
+        else:
+            self.conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_corpus(filename: Path, period: Optional[str] = None, columns: Optional[list[str]] = None) -> pd.DataFrame:
+    '''Load (part of) a corpus; only the requested columns are read'''
+    columns = COLUMNS if columns is None else columns
+    if filename.suffix.lower() == '.parquet':
+        filters = None if period is None else [('period', '==', period)]
+        return pd.read_parquet(filename, columns=columns, filters=filters)
+
+    query = f'SELECT {", ".join(columns)} FROM paragraphs'
+    params = ()
+    if period is not None:
+        query += ' WHERE period=?'
+        params = (period,)
+    conn = sqlite3.connect(str(filename))
+    try:
+        df = pd.read_sql_query(query, conn, params=params)
+    finally:
+        conn.close()
+    if 'is_table' in df:
+        df['is_table'] = df['is_table'].astype(bool)
+    return df
+
+
+def export_period(pdf_path: Path, period: str, corpus: Corpus, workers: int = 4, **kwargs):
+    '''Parse every PDF of a period (in parallel) and stream its paragraphs into the corpus'''
+    kwargs.setdefault('max_pages', None) # Whole documents (yield_paragraphs() stops at 50 pages by default)
+    pdf_fns = sorted(pdf_path.glob('**/*.pdf'))
+    logger.info(f'Exporting {len(pdf_fns)} PDFs of period {period}')
+    for pdf in yield_documents(pdf_fns, workers=workers, **kwargs):
+        corpus.add_document(period, pdf.filename.parent.name, pdf.name, pdf.paragraphs)
+    corpus.flush()
@@ -0,0 +1,253 @@
+'''
+Local stand-in for the OpenAI API (chat completions and batches), to test the LLM client offline
+
+Usage:
+    python fake_openai.py [port] [latency in seconds] [error rate] [truncate rate]
+
+Then point the client at it with LLM(base_url='http://127.0.0.1:<port>/v1') (any API key works)
+'''
+
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+from typing import Optional
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def synthetic_completion(request: dict, truncate: bool = False, answer: Optional[dict] = None) -> dict:
+    '''Deterministic chat completion (as a dict) for a request, or one wrapping the given answer; also used by replay.py'''
+    # The answer depends only on the first user message, so continuations can be served too
+    prompt = next(message['content'] for message in request['messages'] if message['role'] == 'user')
+    digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    if answer is None:
+        answer = {
+            'bank_name': f'Bank {digest[:6]}',
+            'product_name': f'Card {digest[6:12]}',
+            'card_network': ['Visa', 'Mastercard', 'Amex'][int(digest[12], 16) % 3],
+            'gambling_prohibited': ['yes', 'no', 'depends'][int(digest[13], 16) % 3],
+            'gambling_snippet': '',
+        }
+    content = json.dumps(answer)
+    finish_reason = 'stop'
+    partial = [message['content'] for message in request['messages'] if message['role'] == 'assistant']
+    if partial and content.startswith(partial[-1]):
+        content = content[len(partial[-1]):]
+    elif truncate:
+        content = content[:len(content) // 2]
+        finish_reason = 'length'
+    prompt_tokens = len(prompt) // 4 # rough estimate, good enough for a stand-in
+    completion_tokens = len(content) // 4
+    return {
+        'id': f'chatcmpl-{digest[:24]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': request['model'],
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': finish_reason,
+            'logprobs': None,
+        }],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class FakeOpenAI:
+    '''
+    Serves deterministic JSON answers after `latency` seconds
+
+    Keeps simple stats (number of requests, max. requests in flight) so tests can check concurrency
+
+    Batches (files + batches endpoints) are answered with chat_completion() as well; they report
+    "in_progress" for the first `batch_polls` status checks and "completed" afterwards
+
+    Fault injection (chat completions only; reproducible with `seed`):
+    - error_rate: fraction of requests answered with one of `error_statuses` (429, 500, 503 by default)
+    - truncate_rate: fraction of answers cut in half with finish_reason="length"; a follow-up request
+      containing the partial answer gets the rest
+    '''
+
+    def __init__(self, port: int = 0, latency: float = 0.0, batch_polls: int = 1, error_rate: float = 0.0,
+                 truncate_rate: float = 0.0, error_statuses: tuple = (429, 500, 503), seed: int = 0):
+        self.latency = latency
+        self.batch_polls = batch_polls
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.error_statuses = error_statuses
+        self.rng = random.Random(seed)
+        self.num_errors = 0
+        self.num_truncated = 0
+        self.files = {} # id -> (filename, content)
+        self.batches = {} # id -> batch object
+        self.num_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._make_handler())
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+
+
+    def start(self) -> 'FakeOpenAI':
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def chat_completion(self, request: dict, truncate: bool = False) -> dict:
+        return synthetic_completion(request, truncate)
+
+
+    def pick_fault(self) -> tuple[Optional[int], bool]:
+        # Returns the error status to send (or None) and whether to truncate the answer
+        with self.lock:
+            if self.rng.random() < self.error_rate:
+                self.num_errors += 1
+                return self.rng.choice(self.error_statuses), False
+            if self.rng.random() < self.truncate_rate:
+                self.num_truncated += 1
+                return None, True
+            return None, False
+
+
+    def create_file(self, filename: str, content: bytes) -> dict:
+        file_id = f'file-{len(self.files):06d}'
+        self.files[file_id] = (filename, content)
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': 'batch', 'status': 'processed'}
+
+
+    def create_batch(self, request: dict) -> dict:
+        batch_id = f'batch_{len(self.batches):06d}'
+        batch = {
+            'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'], 'input_file_id': request['input_file_id'],
+            'completion_window': request['completion_window'], 'status': 'validating', 'created_at': int(time.time()),
+            'output_file_id': None, 'error_file_id': None, 'polls': 0,
+        }
+        self.batches[batch_id] = batch
+        return self.get_batch(batch_id, poll=False)
+
+
+    def get_batch(self, batch_id: str, poll=True) -> dict:
+        batch = self.batches[batch_id]
+        if poll:
+            batch['polls'] += 1
+            if batch['polls'] > self.batch_polls and batch['status'] != 'completed':
+                batch['output_file_id'] = self._run_batch(batch['input_file_id'])
+                batch['status'] = 'completed'
+            else:
+                batch['status'] = 'in_progress' if batch['status'] != 'completed' else 'completed'
+        return {k: v for k, v in batch.items() if k != 'polls'}
+
+
+    def _run_batch(self, input_file_id: str) -> str:
+        _, content = self.files[input_file_id]
+        lines = []
+        for i, line in enumerate(content.decode('utf-8').splitlines()):
+            request = json.loads(line)
+            response = {'status_code': 200, 'request_id': f'req_{i}', 'body': self.chat_completion(request['body'])}
+            lines.append(json.dumps({'id': f'batch_req_{i}', 'custom_id': request['custom_id'], 'response': response, 'error': None}))
+        output = self.create_file('output.jsonl', '\n'.join(lines).encode('utf-8'))
+        return output['id']
+
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/') # e.g. v1/batches/<id> or v1/files/<id>/content
+                with fake.lock:
+                    if parts[-2:-1] == ['batches'] and parts[-1] in fake.batches:
+                        return self.send_json(200, fake.get_batch(parts[-1]))
+                    if parts[-1] == 'content' and parts[-2] in fake.files:
+                        return self.send_bytes(200, fake.files[parts[-2]][1], 'application/octet-stream')
+                self.send_not_found()
+
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if self.path.endswith('/files'):
+                    # multipart/form-data with the "file" and "purpose" fields
+                    header = f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8')
+                    form = BytesParser(policy=HTTP).parsebytes(header + body)
+                    part = next(part for part in form.iter_parts() if part.get_param('name', header='content-disposition') == 'file')
+                    with fake.lock:
+                        return self.send_json(200, fake.create_file(part.get_filename(), part.get_payload(decode=True)))
+
+                request = json.loads(body or b'{}')
+                if self.path.endswith('/batches'):
+                    with fake.lock:
+                        return self.send_json(200, fake.create_batch(request))
+                if not self.path.endswith('/chat/completions'):
+                    return self.send_not_found()
+
+                with fake.lock:
+                    fake.num_requests += 1
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                try:
+                    time.sleep(fake.latency)
+                    status, truncate = fake.pick_fault()
+                    if status is not None:
+                        error = {'message': f'Injected error {status}', 'type': 'server_error' if status >= 500 else 'rate_limit_error'}
+                        return self.send_json(status, {'error': error})
+                    self.send_json(200, fake.chat_completion(request, truncate=truncate))
+                finally:
+                    with fake.lock:
+                        fake.in_flight -= 1
+
+
+            def send_json(self, status: int, body: dict):
+                self.send_bytes(status, json.dumps(body).encode('utf-8'), 'application/json')
+
+
+            def send_bytes(self, status: int, data: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+
+            def send_not_found(self):
+                self.send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+
+            def log_message(self, format, *args):
+                pass # Keep the console quiet
+
+        return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    truncate_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    fake = FakeOpenAI(port=port, latency=latency, error_rate=error_rate, truncate_rate=truncate_rate)
+    print(f'Fake OpenAI API listening on {fake.base_url}')
+    fake.server.serve_forever()
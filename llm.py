@@ -1,13 +1,26 @@
 import os
+import re
 import json
+import time
+import random
+import asyncio
+import threading
+import contextlib
+import contextvars
 from pathlib import Path
 import hashlib
 from typing import Optional
+from collections import Counter
 
 import tiktoken
 from loguru import logger
-from openai import OpenAI
-from sqlitedict import SqliteDict
+import openai
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletion
+
+from cache import AnswerCache
+from metrics import LLMMetrics
+from utils import count_tokens, get_encoder, normalize_text_for_embedding
 
 
 # To an alternative OpenAI's API KEY
@@ -16,11 +29,252 @@ if False:
     os.environ["OPENAI_API_KEY"] = api_key
 
 
-# Make sure env var exists
-if "OPENAI_API_KEY" in os.environ:
-    print('Ok: API key present in env')
-else:
-    exit('Error: API key not present')
+def check_api_key():
+    # Only needed when calling OpenAI's API (not for local servers or replay clients)
+    if "OPENAI_API_KEY" not in os.environ:
+        raise RuntimeError('Error: API key not present (set the OPENAI_API_KEY env var)')
+
+
+# Default rate limits (these are the tier-1 limits for gpt-4o; raise them to match the account's tier)
+# See: https://platform.openai.com/docs/guides/rate-limits
+DEFAULT_RPM = 500
+DEFAULT_TPM = 30_000
+
+# Max. tokens of context we send per model (leaving some space for the question and the answer)
+# "This model's maximum context length is 16385 tokens." (gpt-3.5-turbo); larger models are capped to keep costs down
+MAX_CONTEXT_TOKENS = {
+    'gpt-3.5-turbo-0125': 10_000,
+    'gpt-4o-2024-05-13': 10_000,
+}
+DEFAULT_MAX_CONTEXT_TOKENS = 10_000
+
+# Retries of transient errors (rate limits, timeouts, 5xx), with exponential backoff and full jitter
+# See: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0 # seconds
+BACKOFF_MAX = 60.0
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) # APITimeoutError is an APIConnectionError
+
+# Answers cut off at max_tokens (finish_reason="length") are continued this many times at most
+MAX_CONTINUATIONS = 2
+
+# Used when no model is given (see LLM.__init__)
+DEFAULT_MODEL = 'gpt-4o-2024-05-13'
+
+# Cascade: every document goes to the cheap model; the expensive one only sees the uncertain ones
+CHEAP_MODEL = 'gpt-3.5-turbo-0125'
+EXPENSIVE_MODEL = 'gpt-4o-2024-05-13'
+
+# Fields of the answer (see the question in main.py)
+ANSWER_FIELDS = ('bank_name', 'product_name', 'card_network', 'gambling_prohibited', 'gambling_snippet')
+
+# Metrics of the question being answered (see find_answer(metrics=...)); every asyncio task has its own
+_question_metrics = contextvars.ContextVar('question_metrics', default=None)
+
+
+def get_encoding_name(model: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return 'cl100k_base'
+
+
+def truncate_context(context: str, max_tokens: int, encoding_name: str = 'cl100k_base') -> str:
+    '''
+    Cut the context to at most max_tokens tokens, dropping whole paragraphs (separated by empty lines)
+
+    If even the first paragraph doesn't fit, it is cut at the token level
+    '''
+    # Tokens are at least one byte long (byte-level BPE; a character can take several tokens), so short contexts always fit
+    if len(context.encode('utf-8')) <= max_tokens:
+        return context
+
+    enc = get_encoder(encoding_name)
+    paras = context.split('\n\n')
+    sizes = [len(tokens) for tokens in enc.encode_ordinary_batch(paras)]
+
+    # Estimate how many paragraphs fit (the separator is one token)...
+    num_tokens = -1
+    keep = 0
+    for size in sizes:
+        if num_tokens + 1 + size > max_tokens:
+            break
+        num_tokens += 1 + size
+        keep += 1
+
+    def fits(num_paras: int) -> bool:
+        return len(enc.encode_ordinary('\n\n'.join(paras[:num_paras]))) <= max_tokens
+
+    # ... and correct it with exact counts, as tokens can merge across paragraph boundaries (the estimate is off either way)
+    while keep < len(paras) and fits(keep + 1):
+        keep += 1
+    while keep > 0 and not fits(keep):
+        keep -= 1
+
+    if keep == len(paras):
+        return context
+    logger.info(f' - Warning: had to reduce the size of the context to fit max context length (was: ~{sum(sizes) + len(sizes) - 1} tokens)')
+    if keep > 0:
+        return '\n\n'.join(paras[:keep])
+
+    # Cut the first paragraph at the token level, on a character boundary (a token can hold part of a multi-byte
+    # character, which decode() would turn into a replacement character, i.e. more tokens)
+    tokens = enc.encode_ordinary(paras[0])[:max_tokens]
+    while tokens:
+        truncated = enc.decode_bytes(tokens).decode('utf-8', errors='ignore')
+        if len(enc.encode_ordinary(truncated)) <= max_tokens:
+            return truncated
+        tokens = tokens[:-1]
+    return ''
+
+
+class RateLimiter:
+    '''
+    Token buckets for requests per minute and tokens per minute
+
+    reserve() takes the request out of the buckets right away (they can go negative) and returns
+    how long the caller has to wait, so the same limiter can pace threads and asyncio tasks
+    '''
+
+    def __init__(self, rpm: float = DEFAULT_RPM, tpm: float = DEFAULT_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm # Start with full buckets
+        self.tokens = tpm
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def reserve(self, tokens: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+            self.requests -= 1
+            self.tokens -= min(tokens, self.tpm) # A request larger than the bucket would otherwise wait forever
+            return max(0.0, -self.requests * 60 / self.rpm, -self.tokens * 60 / self.tpm)
+
+
+    def acquire(self, tokens: int):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    async def acquire_async(self, tokens: int):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    '''
+    Stops calling the API after `failure_threshold` consecutive failures
+
+    While open, calls fail right away (instead of each one retrying for minutes); after `reset_timeout`
+    seconds one call is let through and, if it works, the breaker closes again
+    '''
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 120):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic() # Half-open: let one call through
+                return True
+            return False
+
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error(f'Circuit breaker open after {self.failures} consecutive failures')
+                self.opened_at = time.monotonic()
+
+
+def get_backoff_delay(attempt: int, error: Exception) -> float:
+    # Use the server's hint if there is one
+    response = getattr(error, 'response', None)
+    retry_after = None if response is None else response.headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+@contextlib.contextmanager
+def recording_to(metrics: Optional[LLMMetrics]):
+    # Record the calls, cache lookups, retries and errors of the current question (thread or task) in metrics
+    token = _question_metrics.set(metrics)
+    try:
+        yield
+    finally:
+        _question_metrics.reset(token)
+
+
+def parse_json_answer(content: Optional[str]) -> Optional[dict]:
+    # None if the content isn't a JSON object (e.g. cut off)
+    try:
+        ans = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    return ans if isinstance(ans, dict) else None
+
+
+class OpenAIBatchTransport:
+    '''
+    Submits JSONL batch files through OpenAI's Batch API and polls them
+
+    Any object with the same three methods can be passed to LLM.run_batch() instead
+    (e.g. to test offline, or with this same class pointed at fake_openai.FakeOpenAI)
+    See: https://platform.openai.com/docs/guides/batch
+    '''
+
+    def __init__(self, client: OpenAI):
+        self.client = client
+
+
+    def submit(self, batch_fn: Path) -> str:
+        # Returns the batch id
+        input_file = self.client.files.create(file=batch_fn, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions', completion_window='24h')
+        return batch.id
+
+
+    def status(self, batch_id: str) -> tuple[str, Optional[str]]:
+        # Returns the status ("validating", "in_progress", "completed", "failed", ...) and the output file id
+        batch = self.client.batches.retrieve(batch_id)
+        return batch.status, batch.output_file_id
+
+
+    def download(self, file_id: str) -> list[dict]:
+        text = self.client.files.content(file_id).text
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
 
 
 class LLM:
@@ -31,9 +285,31 @@ class LLM:
     def __init__(
         self,
         model: Optional[str] = None,
-        cache_filename: Optional[Path] = None
+        cache_filename: Optional[Path] = None,
+        cache: Optional[AnswerCache] = None,
+        base_url: Optional[str] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        max_concurrency: int = 8,
+        max_context_tokens: Optional[int] = None,
+        max_retries: int = MAX_RETRIES,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        client=None,
+        async_client=None,
+        metrics: Optional[LLMMetrics] = None
     ):
-        self.client = OpenAI()
+        # client/async_client replace the OpenAI clients (e.g. replay.ReplayClient/AsyncReplayClient to run offline)
+        self.base_url = base_url # None -> OpenAI's API (or the OPENAI_BASE_URL env var)
+        if client is None:
+            if self.base_url is None:
+                check_api_key()
+            api_key = None if "OPENAI_API_KEY" in os.environ else 'local' # Local servers accept any key
+            client = OpenAI(base_url=self.base_url, api_key=api_key, max_retries=0) # We do our own retries
+        self.client = client
+        self.shared_async_client = async_client
+
+        # Failed questions return an answer with source="error" (not cached, so they are asked again on the next run)
+        self.max_retries = max_retries
+        self.circuit_breaker = CircuitBreaker() if circuit_breaker is None else circuit_breaker
 
         # Current list of models:
         # https://platform.openai.com/docs/models
@@ -44,17 +320,44 @@ class LLM:
 
         #default_model = 'gpt-4-turbo-2024-04-09'
         #default_model = 'gpt-4-0613'
-        default_model = 'gpt-4o-2024-05-13' # $5 per 1m tokens; at 8k tokens per file this is only ~100 files
+        default_model = DEFAULT_MODEL # 'gpt-4o-2024-05-13': $5 per 1m tokens; at 8k tokens per file this is only ~100 files
         #default_model = 'gpt-3.5-turbo-0125' # $0.5 per 1m tokens! Much cheaper; not as good
 
         self.model = default_model if model is None else model
-        self.use_cache = cache_filename is not None
-        self.usage = 0
+        self.use_cache = cache_filename is not None or cache is not None
+
+        # Contexts are truncated with the model's own tokenizer
+        self.encoding_name = get_encoding_name(self.model)
+        self.max_context_tokens = MAX_CONTEXT_TOKENS.get(self.model, DEFAULT_MAX_CONTEXT_TOKENS) if max_context_tokens is None else max_context_tokens
 
+        # Tokens, cost, latency, cache hits, retries and errors (can be shared between LLM objects)
+        self.metrics = LLMMetrics() if metrics is None else metrics
+        self.usage = 0 # Total tokens of our API calls
+
+        # Requests are paced by the rate limiter (which can be shared between LLM objects)
+        # find_answers() keeps up to max_concurrency requests in flight
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self.max_concurrency = max_concurrency
+
+        # Batch mode: add_to_batch() collects requests that run_batch() submits at once (answers go to the cache)
+        self.batch_requests = {}
+        self.batch_content_keys = {} # exact cache key -> content key
+        self.batch_metrics = {} # exact cache key -> metrics of the question (see find_answer())
+
+        # The cache can be shared (e.g. between LLM objects or periods); otherwise we open our own
+        if self.use_cache:
+            self.cache_db = AnswerCache(cache_filename) if cache is None else cache
+            self.cache_filename = self.cache_db.filename
+            self.owns_cache = cache is None
+
+
+    def close(self):
+        # Write any pending cache entries
         if self.use_cache:
-            self.cache_filename = cache_filename
-            logger.info(f'Connecting to LLM cache "{self.cache_filename}"')
-            self.cache_db = SqliteDict(str(self.cache_filename))
+            if self.owns_cache:
+                self.cache_db.close()
+            else:
+                self.cache_db.commit()
 
 
     def find_answer(
@@ -63,8 +366,287 @@ class LLM:
             context: str,
             question_fn: Optional[Path] = None,
             temperature: float = 0.2,
-            verbose: bool = False
+            verbose: bool = False,
+            metrics: Optional[LLMMetrics] = None
         ):
+        # metrics: also record this question there (e.g. its period's metrics, with self.metrics as parent)
+        with recording_to(metrics):
+            full_question, keys = self._prepare(question, context, question_fn)
+            ans = self._get_cached(keys, full_question, verbose)
+            if ans is not None:
+                return ans
+
+            logger.info(f'     Querying LLM (model="{self.model}")')
+            request = self._get_request(full_question, temperature)
+            try:
+                response = self._create(request)
+                content, usage = response.choices[0].message.content or '', response.usage.total_tokens
+                for _ in range(MAX_CONTINUATIONS):
+                    if response.choices[0].finish_reason != 'length' or parse_json_answer(content) is not None:
+                        break
+                    response = self._create(self._get_continuation_request(request, content))
+                    content, usage = content + (response.choices[0].message.content or ''), usage + response.usage.total_tokens
+            except (openai.OpenAIError, CircuitOpenError) as e:
+                return self._get_error(type(e).__name__, str(e), temperature)
+            return self._parse_response(response, content, usage, full_question, keys, temperature, verbose)
+
+
+    async def find_answer_async(
+            self,
+            question: str,
+            context: str,
+            question_fn: Optional[Path] = None,
+            temperature: float = 0.2,
+            verbose: bool = False,
+            metrics: Optional[LLMMetrics] = None
+        ):
+        # Same as find_answer() but using the async client (see find_answers)
+
+        # metrics: also record this question there (e.g. its period's metrics, with self.metrics as parent)
+        with recording_to(metrics):
+            full_question, keys = self._prepare(question, context, question_fn)
+            ans = self._get_cached(keys, full_question, verbose)
+            if ans is not None:
+                return ans
+
+            async with self.semaphore:
+                logger.info(f'     Querying LLM (model="{self.model}")')
+                request = self._get_request(full_question, temperature)
+                try:
+                    response = await self._create_async(request)
+                    content, usage = response.choices[0].message.content or '', response.usage.total_tokens
+                    for _ in range(MAX_CONTINUATIONS):
+                        if response.choices[0].finish_reason != 'length' or parse_json_answer(content) is not None:
+                            break
+                        response = await self._create_async(self._get_continuation_request(request, content))
+                        content, usage = content + (response.choices[0].message.content or ''), usage + response.usage.total_tokens
+                except (openai.OpenAIError, CircuitOpenError) as e:
+                    return self._get_error(type(e).__name__, str(e), temperature)
+            return self._parse_response(response, content, usage, full_question, keys, temperature, verbose)
+
+
+    @property
+    def current_metrics(self) -> LLMMetrics:
+        # The current question's metrics if it has some (see recording_to()), else ours
+        metrics = _question_metrics.get()
+        return self.metrics if metrics is None else metrics
+
+
+    def _create(self, request: dict):
+        # One API call, retrying transient errors (the rate limiter is asked again before each attempt)
+        for attempt in range(self.max_retries + 1):
+            if not self.circuit_breaker.allow():
+                raise CircuitOpenError('Too many consecutive API errors; not calling the API for now')
+            self.rate_limiter.acquire(count_tokens(request['messages'][-1]['content']))
+            start = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(**request)
+            except RETRYABLE_ERRORS as e:
+                self.circuit_breaker.record_failure() # Every failed call counts towards opening the circuit
+                if attempt == self.max_retries:
+                    raise
+                self.current_metrics.record_retry(self.model) # Only calls that are tried again
+                delay = get_backoff_delay(attempt, e)
+                logger.warning(f'     {type(e).__name__}; retrying in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})')
+                time.sleep(delay)
+            else:
+                self.circuit_breaker.record_success()
+                self._record_usage(response, time.perf_counter() - start)
+                return response
+
+
+    async def _create_async(self, request: dict):
+        # Same as _create() with the async client
+        for attempt in range(self.max_retries + 1):
+            if not self.circuit_breaker.allow():
+                raise CircuitOpenError('Too many consecutive API errors; not calling the API for now')
+            await self.rate_limiter.acquire_async(count_tokens(request['messages'][-1]['content']))
+            start = time.perf_counter()
+            try:
+                response = await self.async_client.chat.completions.create(**request)
+            except RETRYABLE_ERRORS as e:
+                self.circuit_breaker.record_failure() # Every failed call counts towards opening the circuit
+                if attempt == self.max_retries:
+                    raise
+                self.current_metrics.record_retry(self.model) # Only calls that are tried again
+                delay = get_backoff_delay(attempt, e)
+                logger.warning(f'     {type(e).__name__}; retrying in {delay:.1f}s (attempt {attempt + 1} of {self.max_retries})')
+                await asyncio.sleep(delay)
+            else:
+                self.circuit_breaker.record_success()
+                self._record_usage(response, time.perf_counter() - start)
+                return response
+
+
+    def find_answers(self, requests: list[dict]) -> list[dict]:
+        '''
+        Answer many questions concurrently
+
+        Each request is a dict with the arguments of find_answer(); answers are returned in the same order
+        '''
+        return asyncio.run(self._find_answers(requests))
+
+
+    async def _find_answers(self, requests: list[dict]) -> list[dict]:
+        async with self.async_session():
+            return await asyncio.gather(*(self.find_answer_async(**request) for request in requests))
+
+
+    @contextlib.asynccontextmanager
+    async def async_session(self):
+        '''Set up find_answer_async() for the running event loop (the async client is bound to it, so we create one per loop)'''
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self.shared_async_client is not None:
+            self.async_client = self.shared_async_client
+            yield self
+            return
+
+        api_key = None if "OPENAI_API_KEY" in os.environ else 'local'
+        self.async_client = AsyncOpenAI(base_url=self.base_url, api_key=api_key, max_retries=0)
+        try:
+            yield self
+        finally:
+            await self.async_client.close()
+
+
+    def add_to_batch(
+            self,
+            question: str,
+            context: str,
+            question_fn: Optional[Path] = None,
+            temperature: float = 0.2,
+            verbose: bool = False,
+            metrics: Optional[LLMMetrics] = None
+        ) -> bool:
+        '''Queue a question for run_batch() (unless it's already cached); returns True if it was queued'''
+        assert self.use_cache, 'Batch mode stores the answers in the cache'
+        full_question, keys = self._prepare(question, context, question_fn)
+        h, content_h = keys
+        if h in self.batch_requests or h in self.cache_db or content_h in self.cache_db:
+            return False
+        self.batch_content_keys[h] = content_h
+        if metrics is not None:
+            self.batch_metrics[h] = metrics
+
+        # The cache key is the custom_id, so results can be matched back to their prompt
+        self.batch_requests[h] = {
+            'custom_id': h,
+            'method': 'POST',
+            'url': '/v1/chat/completions',
+            'body': self._get_request(full_question, temperature),
+        }
+        return True
+
+
+    def run_batch(
+            self,
+            batch_path: Path,
+            transport=None,
+            poll_interval: float = 60,
+            max_requests: int = 50_000,
+            max_bytes: int = 190 * 2**20
+        ) -> int:
+        '''
+        Submit all queued requests as JSONL batch files, wait for them and store the answers in the cache
+
+        Batches are ~50% cheaper than regular requests and have their own (much higher) rate limits
+        The Batch API takes up to 50k requests and 200MB per file, so larger batches are split
+        Returns the number of answers stored
+        '''
+        transport = OpenAIBatchTransport(self.client) if transport is None else transport
+        requests = list(self.batch_requests.values())
+        if not requests:
+            return 0
+
+        # Split requests into files
+        batch_path.mkdir(exist_ok=True, parents=True)
+        batch_fns = []
+        lines, size = [], 0
+        for request in requests + [None]:
+            line = None if request is None else json.dumps(request) + '\n'
+            if lines and (line is None or len(lines) >= max_requests or size + len(line.encode('utf-8')) > max_bytes):
+                batch_fn = batch_path / f'batch-{len(batch_fns):03d}.jsonl'
+                batch_fn.write_text(''.join(lines), encoding='utf-8')
+                batch_fns.append(batch_fn)
+                lines, size = [], 0
+            if line is not None:
+                lines.append(line)
+                size += len(line.encode('utf-8'))
+
+        batch_ids = [transport.submit(batch_fn) for batch_fn in batch_fns]
+        logger.info(f'Submitted {len(requests)} requests in {len(batch_ids)} batches: {batch_ids}')
+
+        num_answers = 0
+        pending = set(batch_ids)
+        while pending:
+            for batch_id in sorted(pending):
+                status, output_file_id = transport.status(batch_id)
+                if status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+                    continue
+                pending.discard(batch_id)
+                if status != 'completed':
+                    logger.warning(f'Batch {batch_id} ended with status "{status}"')
+                if output_file_id is None:
+                    continue # No request was answered (or all failed)
+                # Expired and cancelled batches still have (and bill) the answers they finished
+                num_answers += self._store_batch_results(transport.download(output_file_id))
+            if pending:
+                logger.info(f' - Waiting for {len(pending)} batches')
+                time.sleep(poll_interval)
+
+        self.batch_requests = {}
+        self.batch_content_keys = {}
+        self.batch_metrics = {}
+        logger.info(f'Stored {num_answers} of {len(requests)} batch answers in the cache')
+        return num_answers
+
+
+    def _store_batch_results(self, results: list[dict]) -> int:
+        num_answers = 0
+        for result in results:
+            h = result['custom_id']
+            response = result.get('response') or {}
+            if response.get('status_code') != 200:
+                logger.warning(f' - Batch request {h} failed: {result.get("error")}')
+                continue
+
+            # Same checks as for regular responses; failed answers aren't cached (they will be retried)
+            response = ChatCompletion.model_validate(response['body'])
+            self._record_usage(response, batch=True, metrics=self.batch_metrics.get(h))
+            finish_reason = response.choices[0].finish_reason
+            ans = parse_json_answer(response.choices[0].message.content) if finish_reason in ('stop', 'length') else None
+            if ans is None:
+                logger.warning(f' - Batch request {h} finished with "{finish_reason}" and no usable answer')
+                continue
+            ans['usage'] = response.usage.total_tokens
+            self._put_cached((h, self.batch_content_keys.get(h)), ans)
+            num_answers += 1
+
+        self.cache_db.commit()
+        return num_answers
+
+
+    def get_batch_answer(
+            self,
+            question: str,
+            context: str,
+            question_fn: Optional[Path] = None,
+            temperature: float = 0.2,
+            verbose: bool = False,
+            metrics: Optional[LLMMetrics] = None
+        ) -> dict:
+        '''Answer of a question sent with run_batch(), from the cache only (an error answer if the batch didn't answer it)'''
+        with recording_to(metrics):
+            full_question, keys = self._prepare(question, context, question_fn)
+            ans = self._get_cached(keys, full_question, verbose)
+            if ans is None:
+                # Never fall back to the regular (full price) API here; error answers are asked again on the next run
+                return self._get_error('batch_missing', 'The batch returned no usable answer for this question', temperature)
+            return ans
+
+
+    def _prepare(self, question: str, context: str, question_fn: Optional[Path] = None) -> tuple[str, Optional[tuple[str, str]]]:
+        # Returns the full question and its cache keys
 
         # Parameter reference :
         # https://platform.openai.com/docs/api-reference/chat/create?lang=python
@@ -76,42 +658,57 @@ class LLM:
         # temperature
         
         # VALIDATE TOKEN LENGTH OF QUESTION
-        # "This model's maximum context length is 16385 tokens."
-        enc = tiktoken.get_encoding("cl100k_base")
-        num_tokens = len(enc.encode(context))
-        if num_tokens >= 10000: # Leave some space for question and token-string mismatch
-            ratio = 10000 / num_tokens
-            new_len = int(ratio * len(context)) + 1
-            logger.info(f' - Warning: had to reduce the size of the context to fit max context length (was: {num_tokens})')
-            context = context[:new_len]
+        context = truncate_context(context, self.max_context_tokens, self.encoding_name)
         
-        print(len(context))
-        print(len(question))
+        logger.debug(f'     Context: {len(context)} characters; question: {len(question)} characters')
         
         full_question = question + context
 
         if question_fn is not None:
             question_fn.write_text(full_question, encoding='utf-8')
 
-        # Load data from cache if available
+        keys = None
         if self.use_cache:
-            augmented_question = full_question + '\n' + f'INFO: llm={self.model}'
-            h = hashlib.sha256(augmented_question.encode('utf-8')).hexdigest()
-            ans = self.cache_db.get(h)
-            if ans is not None:
-                logger.info('     Loading LLM response from cache')
-                if verbose:
-                    print('=' * 24, f'LLM Prompt', '=' * 24)
-                    print(full_question)
-                ans['source'] = 'cache'
-                ans['usage'] = 0
-                return ans
+            keys = (self._get_key(full_question), self._get_content_key(question, context))
+        return full_question, keys
+
+
+    def _get_key(self, full_question: str) -> str:
+        # Exact key: the prompt as sent
+        augmented_question = full_question + '\n' + f'INFO: llm={self.model}'
+        return hashlib.sha256(augmented_question.encode('utf-8')).hexdigest()
+
 
-     
+    def _get_content_key(self, question: str, context: str) -> str:
+        # Content key: the same agreement is often filed again in later periods, with different
+        # line breaks, spacing or punctuation; those should reuse the earlier answer
+        normalized_context = normalize_text_for_embedding(' '.join(context.split()))
+        augmented_question = question + '\n' + normalized_context + '\n' + f'INFO: llm={self.model}'
+        return 'content-' + hashlib.sha256(augmented_question.encode('utf-8')).hexdigest()
 
-        logger.info(f'     Querying LLM (model="{self.model}")')
 
-        response = self.client.chat.completions.create(
+    def _get_cached(self, keys: Optional[tuple[str, str]], full_question: str, verbose: bool = False) -> Optional[dict]:
+        # Load data from cache if available (exact prompt first, then same content)
+        if keys is None:
+            return None
+        h, content_h = keys
+        key, ans = self.cache_db.get_first([h, content_h]) # One hit or miss per question
+        if key == content_h:
+            logger.info('     Reusing LLM response of a document with the same content')
+            self.cache_db.put(h, ans)
+        self.current_metrics.record_cache(ans is not None)
+        if ans is not None:
+            logger.info('     Loading LLM response from cache')
+            if verbose:
+                print('=' * 24, f'LLM Prompt', '=' * 24)
+                print(full_question)
+            ans['source'] = 'cache'
+            ans['usage'] = 0
+        return ans
+
+
+    def _get_request(self, full_question: str, temperature: float) -> dict:
+        return dict(
           model = self.model,
           response_format = { "type": "json_object" },
           max_tokens = 2000,
@@ -124,6 +721,49 @@ class LLM:
           ]
         )
 
+
+    def _record_usage(self, response, latency: Optional[float] = None, batch: bool = False, metrics: Optional[LLMMetrics] = None):
+        if response.usage is None:
+            return
+        self.usage += response.usage.total_tokens
+        metrics = self.current_metrics if metrics is None else metrics
+        metrics.record_call(self.model, response.usage.prompt_tokens, response.usage.completion_tokens, latency, batch)
+
+
+    def _get_continuation_request(self, request: dict, content: str) -> dict:
+        # Ask the model to go on from where it was cut off; its reply is appended to the partial answer
+        # (JSON mode is off, as it would start a new JSON object)
+        messages = request['messages'] + [
+            {"role": "assistant", "content": content},
+            {"role": "user", "content": "Your answer was cut off. Continue exactly where you left off, without repeating anything."},
+        ]
+        logger.warning(f'     Answer was cut off at {len(content)} characters; asking the model to continue')
+        return {**{k: v for k, v in request.items() if k != 'response_format'}, 'messages': messages}
+
+
+    def _get_error(self, error: str, message: str, temperature: float) -> dict:
+        # Answer returned when we couldn't get one; it isn't cached so the question is asked again next time
+        logger.error(f'     LLM query failed ({error}): {message}')
+        self.current_metrics.record_error(error)
+        return {
+            'source': 'error',
+            'error': error,
+            'error_message': message,
+            'usage': 0,
+            'llm': self.model,
+            'temperature': temperature,
+        }
+
+
+    def _put_cached(self, keys: tuple[str, Optional[str]], ans: dict):
+        # Stored under both keys (committed in groups by the cache)
+        for key in keys:
+            if key is not None:
+                self.cache_db.put(key, ans)
+
+
+    def _parse_response(self, response, content: str, usage: int, full_question: str, keys: Optional[tuple[str, str]], temperature: float, verbose: bool = False) -> dict:
+        # content and usage include any continuations
         if verbose:
             print('=' * 24, f'LLM Prompt', '=' * 24)
             print(full_question)
@@ -133,33 +773,125 @@ class LLM:
 
         # Response API:
         # https://platform.openai.com/docs/api-reference/chat/object
+        # (JSON mode can pad a finished answer with whitespace until it hits max_tokens, so "length" answers are fine if they parse)
         finish_reason = response.choices[0].finish_reason
-        if finish_reason != 'stop':
-            print(f'WARNING!!! Finish reason was "{finish_reason}"')
-            print('==== QUESTION:')
-            print(full_question)
-            print('==== RESPONSE:')
-            print(response)
-            print('==== REASON:')
-            print(response.choices[0].finish_reason)
-            print()
-            assert False # FIX
-            ans = {'success': False, 'start': None, 'end': None, 'source': 'error'}
-        else:
-            ans = response.choices[0].message.content
-            assert ans is not None
-            ans = json.loads(ans)
-            assert response.usage is not None
-            usage = response.usage.total_tokens
-            ans['usage'] = usage
-            
-            if self.use_cache:
-                self.cache_db[h] = ans
-                self.cache_db.commit()
-            
-            ans['source'] = 'llm'
+        ans = parse_json_answer(content) if finish_reason in ('stop', 'length') else None
+        if ans is None:
+            error = 'invalid_json' if finish_reason == 'stop' else finish_reason
+            return self._get_error(error, f'Unusable response (finish reason "{finish_reason}"): {content[:200]!r}', temperature)
 
+        ans['usage'] = usage
+        if self.use_cache:
+            self._put_cached(keys, ans)
+        ans['source'] = 'llm'
         ans['llm'] = self.model
         ans['temperature'] = temperature
         return ans
 
+
+def needs_escalation(ans: dict, context: str) -> Optional[str]:
+    '''Reason to ask a better model ("error", "malformed", "empty", "depends", "snippet_not_found"), or None if the answer looks fine'''
+    if ans.get('source') == 'error':
+        return 'error'
+    if any(not isinstance(ans.get(field), str) for field in ANSWER_FIELDS):
+        return 'malformed'
+    if not any(ans[field].strip() for field in ANSWER_FIELDS):
+        return 'empty'
+
+    gambling_prohibited = ans['gambling_prohibited'].strip().lower()
+    if gambling_prohibited == 'depends':
+        return 'depends'
+    if gambling_prohibited not in ('yes', 'no', ''):
+        return 'malformed'
+
+    # The snippet must be an actual quote (models often paraphrase or make them up); "..." marks omitted text
+    normalize = lambda text: normalize_text_for_embedding(' '.join(text.split()))
+    normalized_context = normalize(context)
+    parts = [normalize(part).strip(' .') for part in re.split(r'\.\.\.|\u2026', ans['gambling_snippet'])]
+    if any(part not in normalized_context for part in parts if part):
+        return 'snippet_not_found'
+    return None
+
+
+class CascadeLLM:
+    '''
+    Ask the cheap model first and the expensive model only when needs_escalation() says so
+
+    Has the same find_answer()/find_answers() interface as LLM; answers get an "escalated" field with the reason (or "")
+    Each model keeps its own cache entries (cache keys include the model) and its own rate limiter
+    '''
+
+    def __init__(self, cheap_model: str = CHEAP_MODEL, expensive_model: str = EXPENSIVE_MODEL, **kwargs):
+        self.metrics = kwargs.setdefault('metrics', LLMMetrics()) # Shared by both models
+        self.cheap = LLM(model=cheap_model, **kwargs)
+        self.expensive = LLM(model=expensive_model, **kwargs)
+        self.stats = Counter() # "documents", "escalated" and one count per reason
+
+
+    @property
+    def usage(self) -> int:
+        return self.cheap.usage + self.expensive.usage
+
+
+    def find_answer(self, question: str, context: str, **kwargs) -> dict:
+        ans = self.cheap.find_answer(question, context, **kwargs)
+        reason = self._check(ans, context)
+        if reason is not None:
+            ans = self.expensive.find_answer(question, context, **kwargs)
+        ans['escalated'] = reason or ''
+        return ans
+
+
+    @property
+    def max_concurrency(self) -> int:
+        return self.cheap.max_concurrency
+
+
+    @contextlib.asynccontextmanager
+    async def async_session(self):
+        async with self.cheap.async_session(), self.expensive.async_session():
+            yield self
+
+
+    async def find_answer_async(self, question: str, context: str, **kwargs) -> dict:
+        # Within async_session()
+        ans = await self.cheap.find_answer_async(question, context, **kwargs)
+        reason = self._check(ans, context)
+        if reason is not None:
+            ans = await self.expensive.find_answer_async(question, context, **kwargs)
+        ans['escalated'] = reason or ''
+        return ans
+
+
+    def find_answers(self, requests: list[dict]) -> list[dict]:
+        answers = self.cheap.find_answers(requests)
+        reasons = [self._check(ans, request['context']) for ans, request in zip(answers, requests)]
+        escalated = [i for i, reason in enumerate(reasons) if reason is not None]
+        if escalated:
+            logger.info(f'Escalating {len(escalated)} of {len(requests)} questions to "{self.expensive.model}"')
+            for i, ans in zip(escalated, self.expensive.find_answers([requests[i] for i in escalated])):
+                answers[i] = ans
+        for ans, reason in zip(answers, reasons):
+            ans['escalated'] = reason or ''
+        return answers
+
+
+    def _check(self, ans: dict, context: str) -> Optional[str]:
+        reason = needs_escalation(ans, context)
+        self.stats['documents'] += 1
+        if reason is not None:
+            self.stats['escalated'] += 1
+            self.stats[reason] += 1
+        return reason
+
+
+    def report(self) -> str:
+        num_documents = self.stats['documents']
+        rate = self.stats['escalated'] / num_documents if num_documents else 0
+        reasons = ', '.join(f'{reason}={count}' for reason, count in self.stats.most_common() if reason not in ('documents', 'escalated'))
+        return f'Escalated {self.stats["escalated"]} of {num_documents} documents ({rate:.1%}) to "{self.expensive.model}"' + (f'; {reasons}' if reasons else '')
+
+
+    def close(self):
+        self.cheap.close()
+        self.expensive.close()
@@ -2,26 +2,42 @@
 Script that processes credit card disclosure files
 <FILL THIS>
 
+Usage:
+
+    python main.py --data-root <folder> [--period 2023-Q4 ...] [--bank-sample ../output/big_sample.tsv] [--dry-run]
+
+(see python main.py --help for the other options)
+
 
 TODO:
 
-- Carefully weight costs of GPT4o and GPT3.5t
-- Consider trimming at a max. number of pages (line 89 of readers.py currently sets that at 50 pages)
+- Carefully weight costs of GPT4o and GPT3.5t (process_period(cascade=True) only sends uncertain answers to GPT4o)
+- Consider trimming at a max. number of pages (yield_paragraphs() stops at max_pages=50 or once token_budget is reached)
 - ...
 - ...
 
 '''
 
 from pathlib import Path
+from typing import Optional
 import pandas as pd
 import click
 import sys
 from loguru import logger
 from tqdm import tqdm
-from readers import PDF, Para
-from llm import LLM
-import time
+from readers import Para, ParaCache
+from llm import LLM, CascadeLLM, RateLimiter, DEFAULT_MODEL, DEFAULT_RPM, DEFAULT_TPM, CHEAP_MODEL, MAX_CONTEXT_TOKENS, DEFAULT_MAX_CONTEXT_TOKENS, get_encoding_name, truncate_context
+from metrics import LLMMetrics, get_cost
+from utils import get_encoder
+from cache import AnswerCache
+from corpus import Corpus
+from results import ResultStore, read_tsv
+from manifest import Manifest
+from pipeline import Pipeline, DocumentJob
+from scheduler import Scheduler
+from retrieval import build_context
 import itertools
+from functools import partial
 import tiktoken
 
 question = '''
@@ -56,131 +72,354 @@ CONTEXT:
 
 '''
 
+# With retrieval on, the LLM only sees the first page plus the paragraphs that best match these queries (one per field)
+FIELD_QUERIES = {
+    'bank_name': 'bank issuer national association N.A. member FDIC we us our',
+    'product_name': 'credit card agreement cardmember account product name rewards platinum',
+    'card_network': 'Visa Mastercard American Express Amex Discover network',
+    'gambling': 'gambling betting wagering casino lottery gaming quasi-cash transactions prohibited',
+}
+
    # "overdraft_fee": "..." # What is the overdraft fee?
     #"interest_rate": "...", # What is the APR for purchases?
    # "annual_fee": "...", # What (if any) is the annual fee?
-# Import restricted bank sample 
-
-df=pd.read_csv('../output/big_sample.tsv', sep='\t')
-
-# Extract the 'name' column and convert it to a set
-bank_sample = set(df['name'])
-
-# Print the set
-print(bank_sample)
-print(len(bank_sample)) 
-
-def process_period(period: str):
-
-    # Parameters
-    base_path = Path('C:/users/shawn/credit-cards-shawn/data/') # "Credit card Agreement database"
-
-    pdf_path = base_path / period
-    assert pdf_path.is_dir()
-
-    questions_path = base_path /  f'questions' / period
-    questions_path.mkdir(exist_ok=True, parents=True)
-
-    cache_path = base_path /  f'llm-cache'
-    cache_path.mkdir(exist_ok=True)
-    cache_filename = cache_path / f'{period}.sqlite'
-    llm = LLM(cache_filename=cache_filename)
-
-    #output_fn = base_path / f'{period}-data.tsv'
-    output_fn = Path('../output') / f'{period}-data.tsv'
-
-    # Ignore already processed files
-    if output_fn.exists():
-        df = pd.read_csv(output_fn, sep='\t')
-        done = df.to_dict(orient='records')
-        done = {(d['bank_name'], d['filename']):d for d in done}
-        #done = df[['bank_name', 'filename']].values.tolist()
-        #done = set( (bank_name, filename) for bank_name, filename in done) # set of tuples
-    else:
-        done = None
-
-    # Process all PDFs
-    answers = []
-    pdf_fns = pdf_path.glob('**/*.pdf')
-    pdf_fns = list(pdf_fns)
-
-    for pdf_fn in pdf_fns:
-        bank_name = pdf_fn.parent.name
-        filename = pdf_fn.stem
-        # bank_sample is a set that I will create previously 
-        if bank_name not in bank_sample:
-            continue
+# Dry run: rough size of an answer (a small JSON object; the gambling snippet is most of it)
+EXPECTED_COMPLETION_TOKENS = 150
+
+
+def read_bank_sample(filename: Path) -> set[str]:
+    # Restricted bank sample: a TSV with a "name" column (bank folder names)
+    df = pd.read_csv(filename, sep='\t')
+    bank_sample = set(df['name'])
+    logger.info(f'Bank sample: {len(bank_sample)} banks from "{filename}"')
+    return bank_sample
+
+
+def get_parse_kwargs(retrieval_k: Optional[int] = None, max_pages: Optional[int] = 50, token_budget: Optional[int] = 10_000) -> dict:
+    # Arguments of PDF.yield_paragraphs() (also part of the paragraph cache key)
+    # The LLM only reads the first ~10k tokens, so don't parse pages beyond that (unless we retrieve from the whole document)
+    return dict(detect_tables=True, max_pages=max_pages, token_budget=None if retrieval_k else token_budget)
+
+
+def document_info(job: DocumentJob, paras: list[Para]) -> dict:
+    ans = {}
+    ans['ok'] = bool(paras)
+    ans['bank_name'] = job.bank_name
+    ans['filename'] = job.filename
+    ans['num_pages'] = paras[-1].page if paras else 0
+    ans['num_paras'] = len(paras)
+    return ans
+
+
+class PeriodRun:
+    '''
+    One period: which documents to process (new, changed or not done yet) and what to do with each of them
+
+    prepare() and finish() are the Pipeline callbacks; each result is saved with the hash of its PDF and
+recorded in the manifest as soon as it's ready; close() exports the TSV and saves the manifest
+    '''
+
+    def __init__(self, period: str, base_path: Path, llm, corpus: Optional[Corpus], results: Optional[ResultStore], batch: bool = False, retrieval_k: Optional[int] = None,
+                 output_path: Path = Path('../output'), bank_sample: Optional[set[str]] = None):
+        # bank_sample: names of the bank folders to process (None: all of them)
+        # llm=None: dry run (see estimate_periods()), only picks the documents to process and writes nothing
+        self.period = period
+        self.base_path = base_path
+        self.llm = llm
+        self.corpus = corpus
+        self.results = results
+        self.batch = batch
+        self.retrieval_k = retrieval_k
+        self.deferred = [] # batch mode: (job, result, request) waiting for the batch to complete
+
+        # This period's tokens, cost, latency, cache hits, retries and errors (also counted in the run's llm.metrics)
+        self.metrics = None if llm is None else LLMMetrics(parent=llm.metrics)
+
+        pdf_path = base_path / period
+        assert pdf_path.is_dir()
+
+        self.questions_path = base_path /  f'questions' / period
+        if llm is not None:
+            self.questions_path.mkdir(exist_ok=True, parents=True)
+
+        #output_fn = base_path / f'{period}-data.tsv'
+        self.output_fn = output_path / f'{period}-data.tsv'
+
+        # Results are saved per document as soon as they are ready (the TSV is exported from them at the end)
+        legacy = (results is None or results.count(period) == 0) and self.output_fn.exists() # From runs before the result store existed
+        if legacy and llm is not None:
+            results.import_tsv(period, self.output_fn)
+
+        # Ignore already processed files (failed questions are asked again)
+        # done: (bank_name, filename) -> sha256 of the PDF when it was processed (None: unknown)
+        if legacy and llm is None:
+            done = {(row['bank_name'], row['filename']): None for row in read_tsv(self.output_fn) if row.get('source') != 'error'}
+        else:
+            done = {} if results is None else results.hashes(period)
+
+        # Process all PDFs
+        pdf_fns = pdf_path.glob('**/*.pdf')
+        pdf_fns = [pdf_fn for pdf_fn in sorted(pdf_fns) if bank_sample is None or pdf_fn.parent.name in bank_sample]
+
+        # Files without a result or whose contents changed since are (re)processed; the others are skipped without opening them
+        # Results without a hash (imported TSVs) are kept unless the manifest says the file changed; files "new" to the
+        # manifest but with a result (e.g. we crashed before saving the manifest, or it didn't exist yet) are adopted
+        self.manifest = Manifest(base_path / 'manifests' / f'{period}.json', pdf_path)
+        status = self.manifest.scan(pdf_fns)
+        self.jobs = []
+        skipped = []
+        for pdf_fn in pdf_fns:
+            key = (pdf_fn.parent.name, pdf_fn.stem)
+            sha256 = self.manifest.get_sha256(pdf_fn)
+            if key in done and (done[key] == sha256 or (done[key] is None and status[self.manifest.get_path(pdf_fn)] != 'changed')):
+                skipped.append(pdf_fn)
+            else:
+                self.jobs.append(DocumentJob(period, pdf_fn, sha256))
+        if llm is not None:
+            self.manifest.commit(skipped)
+        logger.info(f'Period {period}: {len(self.jobs)} of {len(pdf_fns)} documents to process')
+
+
+    def prepare(self, job: DocumentJob, paras: list[Para]) -> Optional[dict]:
+        # Returns the LLM question for the document (None if there is nothing to ask)
+        print(job.filename)
+        if not paras:
+            return None # Scanned PDF???
+
+        if self.corpus is not None:
+            self.corpus.add_document(self.period, job.bank_name, job.filename, paras)
+        logger.info(f' - Firm="{job.bank_name}". filename="{job.filename}"; {paras[-1].page} pages; {len(paras)} paragraphs')
+        context = self.get_context(paras)
+        path = self.questions_path / job.bank_name
+        path.mkdir(exist_ok=True)
+        question_fn = path / f'{job.filename}.txt'
+        request = dict(question=question, context=context, question_fn=question_fn, verbose=False, metrics=self.metrics)
+        if self.batch:
+            self.llm.add_to_batch(**request)
+            self.deferred.append((job, document_info(job, paras), request))
+            return None
+        return request
+
+
+    def get_context(self, paras: list[Para]) -> str:
+        if self.retrieval_k:
+            return build_context(paras, FIELD_QUERIES.values(), k=self.retrieval_k)
+        return '\n\n'.join(para.text for para in paras)
+
+
+    def finish(self, job: DocumentJob, paras: list[Para], ans: Optional[dict]) -> dict:
+        if job.error is not None:
+            ans = {'source': 'error', 'error': 'parse_error', 'error_message': job.error} # Parsed again on the next run
+        ans = document_info(job, paras) if ans is None else {**ans, **document_info(job, paras)}
+        print(ans)
+        if not (self.batch and paras):
+            self.save(job, ans)
+        return ans
 
-        print(filename)
-        time.sleep(6)
 
+    def save(self, job: DocumentJob, ans: dict):
+        self.results.put(self.period, ans, sha256=job.sha256)
+        self.manifest.commit([job.pdf_fn])
 
 
-        # Avoid reading pdfs (slow) for already processed files
-        if done and (bank_name, filename) in done:
-            answers.append(done[bank_name, filename])
-            continue
+    def finish_batch(self):
+        # Once the batch is done, its answers are in the cache; questions it didn't answer (failed or expired batches)
+        # are saved as errors, so the next run asks them again, instead of sending them to the full price API now
+        for job, info, request in self.deferred:
+            self.save(job, {**self.llm.get_batch_answer(**request), **info})
+        self.deferred = []
 
-        if 
 
-        pdf = PDF(pdf_fn)
-        paras = [para for para in pdf.yield_paragraphs(detect_tables=True)]
+    def close(self, *args):
+        # Save table
+        self.results.export_tsv(self.period, self.output_fn)
+        self.manifest.save()
 
+        # Tokens, cost and latency of this period (for capacity and budget planning)
+        logger.info(f'Period {self.period}: {self.metrics}')
+        self.metrics.write(self.base_path / 'metrics' / f'{self.period}.json', period=self.period, num_documents=len(self.jobs))
 
-        if not paras:
-            # Scanned PDF???
-            ans = {}
-            num_pages = 0
-            num_paras = 0
-            ok = False
-        else:
-            num_pages = paras[-1].page
-            num_paras = len(paras)
-            logger.info(f' - Firm="{bank_name}". filename="{filename}"; {num_pages} pages; {num_paras} paragraphs')
-            context = '\n\n'.join(para.text for para in paras)
-            path = questions_path / bank_name
-            path.mkdir(exist_ok=True)
-            question_fn = path / '{filename}.txt'
-            ans = llm.find_answer(question, context, question_fn=question_fn, verbose=False)
-            ok = True
-
-
-        #check_text_under_limit('paras')
-
-        ans['ok'] = ok
-        ans['bank_name'] = bank_name
-        ans['filename'] = filename
-        ans['num_pages'] = num_pages
-        ans['num_paras'] = num_pages
-        print(ans)
 
-        answers.append(ans)
+def process_periods(periods: list[str], base_path: Path, output_path: Path = Path('../output'), bank_sample: Optional[set[str]] = None,
+                    model: Optional[str] = None, batch: bool = False, retrieval_k: Optional[int] = None, cascade: bool = False, llm_kwargs: Optional[dict] = None,
+                    parse_workers: int = 4, max_queued: int = 16, max_concurrency: int = 8, rpm: float = DEFAULT_RPM, tpm: float = DEFAULT_TPM,
+                    max_pages: Optional[int] = 50, token_budget: Optional[int] = 10_000):
+    # base_path holds one folder of PDFs per period ("Credit card Agreement database"); caches and results are saved there too
+    # bank_sample restricts the banks processed (see read_bank_sample()); {period}-data.tsv tables are exported to output_path
+    # All periods share one parse pool, one LLM (rate limit, retries, answer cache) and one corpus (see scheduler.py)
+    # batch=True sends all questions through the Batch API (cheaper, but answers can take hours)
+    # llm_kwargs are passed to LLM(); e.g. replay.replay_clients(...) to benchmark without network (use a copy of the data folder, as answers are cached)
+    # model defaults to llm.DEFAULT_MODEL; cascade=True asks GPT-3.5T first and the model (GPT-4o) only when the answer looks wrong or uncertain
+    # retrieval_k=k sends only the first page and the top-k paragraphs per FIELD_QUERIES entry (much shorter prompts)
+    # parse_workers processes parse PDFs while the LLM answers (max_concurrency requests at a time); at most max_queued parsed documents wait for the LLM
+    # rpm and tpm are the API rate limits of our account (requests and tokens per minute); with ~10k token prompts, tpm is usually the bottleneck
+    # max_pages and token_budget limit how much of each PDF is parsed (None: no limit)
 
-    # Save table
-    df = pd.DataFrame(answers)
-    df.to_csv(output_fn, sep='\t', index=False)
+    cache_path = base_path /  f'llm-cache'
+    cache_path.mkdir(exist_ok=True)
 
+    # One answer cache for all periods; answers from the old per-period caches are copied over
+    answer_cache = AnswerCache(cache_path / 'answers.sqlite')
+    for period in periods:
+        legacy_cache_filename = cache_path / f'{period}.sqlite'
+        if legacy_cache_filename.exists():
+            answer_cache.import_sqlitedict(legacy_cache_filename)
+    assert not (batch and cascade), 'The cascade needs the cheap answers before deciding what to escalate'
+    llm_kwargs = {} if llm_kwargs is None else llm_kwargs
+    # One rate limiter for all requests (both models of a cascade included)
+    llm_kwargs = {'cache': answer_cache, 'max_concurrency': max_concurrency, 'rate_limiter': RateLimiter(rpm, tpm), **llm_kwargs}
+    if cascade:
+        llm = CascadeLLM(expensive_model=model or DEFAULT_MODEL, **llm_kwargs)
+    else:
+        llm = LLM(model=model, **llm_kwargs)
 
+    # Parsed paragraphs are shared across periods (keys are content hashes, not paths)
+    para_cache = ParaCache(cache_path / 'paragraphs.sqlite')
 
+    # Keep every parsed paragraph (all periods) for later analyses; the corpus must hold whole documents, so only
+    # when they are parsed without page/token limits (else build it with corpus.export_period())
+    parse_kwargs = get_parse_kwargs(retrieval_k, max_pages, token_budget)
+    corpus = None
+    if parse_kwargs['max_pages'] is None and parse_kwargs['token_budget'] is None:
+        corpus = Corpus(base_path / 'corpus.sqlite')
+    else:
+        logger.info('Documents are parsed with page/token limits, so they are not added to the corpus (see corpus.export_period())')
+    results = ResultStore(base_path / 'results.sqlite')
+
+    pipeline = Pipeline(None if batch else llm, para_cache, parse_workers=parse_workers, max_queued=max_queued, **parse_kwargs)
+    scheduler = Scheduler(pipeline)
+    runs = [PeriodRun(period, base_path, llm, corpus, results, batch=batch, retrieval_k=retrieval_k, output_path=output_path, bank_sample=bank_sample)
+            for period in periods]
+    for run in runs:
+        # Periods are finished as soon as their last document is (in batch mode, only after the batch)
+        scheduler.add(run.period, run.jobs, run.prepare, run.finish, on_done=None if batch else run.close)
+    scheduler.run()
+
+    name = periods[0] if len(periods) == 1 else f'{periods[0]}_to_{periods[-1]}'
+    if batch:
+        llm.run_batch(base_path / 'batches' / name)
+        for run in runs:
+            run.finish_batch()
+            run.close()
+
+    if cascade:
+        logger.info(llm.report())
+    if corpus is not None:
+        corpus.close()
+    results.close()
+    answer_cache.close()
+    logger.info(f'Answer cache: {answer_cache.stats}')
+
+    # Totals of all periods (each period's metrics/{period}.json is written as soon as it's done)
+    logger.info(f'Periods {", ".join(periods)}: {llm.metrics}')
+
+
+def process_period(period: str, **kwargs):
+    process_periods([period], **kwargs)
+
+
+def estimate_periods(periods: list[str], base_path: Path, output_path: Path = Path('../output'), bank_sample: Optional[set[str]] = None,
+                     model: Optional[str] = None, batch: bool = False, retrieval_k: Optional[int] = None, cascade: bool = False,
+                     parse_workers: int = 4, max_queued: int = 16, max_pages: Optional[int] = 50, token_budget: Optional[int] = 10_000) -> pd.DataFrame:
+    '''
+    Dry run of process_periods() with the same arguments: projected tokens and cost per period and model, without any API call
+
+    Documents are parsed (or read from the paragraph cache), and their prompts built and tokenized in bulk.
+    Completion tokens are a guess (EXPECTED_COMPLETION_TOKENS per document); answers already in the answer cache are counted too.
+    With cascade=True, the expensive model's row assumes every document is escalated (an upper bound).
+    '''
+    models = [CHEAP_MODEL, model or DEFAULT_MODEL] if cascade else [model or DEFAULT_MODEL]
 
-def main():
+    cache_path = base_path /  f'llm-cache'
+    cache_path.mkdir(exist_ok=True)
+    para_cache = ParaCache(cache_path / 'paragraphs.sqlite')
+    results_fn = base_path / 'results.sqlite' # To skip the documents already done
+    results = ResultStore(results_fn) if results_fn.exists() else None
+
+    # Same documents and contexts as process_periods(), but nothing is sent, saved or exported; only the parsed
+    # paragraphs are kept in the paragraph cache (so the real run doesn't parse the documents again)
+    contexts = {period: [] for period in periods}
+
+    def collect_context(run: PeriodRun, job: DocumentJob, paras: list[Para]):
+        if paras: # Scanned PDFs aren't sent either
+            contexts[job.period].append(run.get_context(paras))
+
+    pipeline = Pipeline(None, para_cache, parse_workers=parse_workers, max_queued=max_queued, **get_parse_kwargs(retrieval_k, max_pages, token_budget))
+    scheduler = Scheduler(pipeline)
+    for period in periods:
+        run = PeriodRun(period, base_path, None, None, results, retrieval_k=retrieval_k, output_path=output_path, bank_sample=bank_sample)
+        scheduler.add(period, run.jobs, partial(collect_context, run), lambda job, paras, ans: None)
+    scheduler.run()
+    if results is not None:
+        results.close()
+
+    rows = []
+    for period in periods:
+        for model_name in models:
+            # Same truncation as LLM._prepare(), with the model's own tokenizer
+            encoding_name = get_encoding_name(model_name)
+            max_context_tokens = MAX_CONTEXT_TOKENS.get(model_name, DEFAULT_MAX_CONTEXT_TOKENS)
+            prompts = [question + truncate_context(context, max_context_tokens, encoding_name) for context in contexts[period]]
+            prompt_tokens = sum(len(tokens) for tokens in get_encoder(encoding_name).encode_ordinary_batch(prompts))
+            completion_tokens = EXPECTED_COMPLETION_TOKENS * len(prompts)
+            rows.append(dict(period=period, model=model_name, documents=len(prompts), prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                             cost_usd=get_cost(model_name, prompt_tokens, completion_tokens, batch)))
+
+    df = pd.DataFrame(rows, columns=['period', 'model', 'documents', 'prompt_tokens', 'completion_tokens', 'cost_usd'])
+    logger.info(f'Dry run: {df["documents"].sum() // len(models)} documents; {df["prompt_tokens"].sum():,} prompt tokens; ${df["cost_usd"].sum():.2f} (projected)')
+    return df
+
+
+@click.command()
+@click.option('--data-root', type=click.Path(exists=True, file_okay=False, path_type=Path), required=True,
+              help='Folder with one subfolder of PDFs per period (caches and results are saved there too)')
+@click.option('--period', 'periods', multiple=True, help='Period to process; can be repeated (default: all subfolders starting with "2")')
+@click.option('--bank-sample', type=click.Path(exists=True, dir_okay=False, path_type=Path), default=None,
+              help='TSV with a "name" column; only these banks are processed (default: all banks)')
+@click.option('--output-dir', type=click.Path(file_okay=False, path_type=Path), default=Path('../output'), show_default=True,
+              help='Where the {period}-data.tsv tables are exported')
+@click.option('--model', default=None, help=f'OpenAI model (default: {DEFAULT_MODEL}; with --cascade, the expensive model)')
+@click.option('--cascade', is_flag=True, help=f'Ask {CHEAP_MODEL} first and the model only for uncertain answers')
+@click.option('--batch', is_flag=True, help='Send all questions through the Batch API (half the price; answers can take hours)')
+@click.option('--retrieval-k', type=int, default=None, help='Send only the first page and the top-k paragraphs per field')
+@click.option('--parse-workers', type=int, default=4, show_default=True, help='Processes parsing PDFs')
+@click.option('--llm-workers', type=int, default=8, show_default=True, help='Concurrent LLM requests')
+@click.option('--rpm', type=float, default=DEFAULT_RPM, show_default=True, help='Rate limit: API requests per minute')
+@click.option('--tpm', type=float, default=DEFAULT_TPM, show_default=True, help='Rate limit: API tokens per minute')
+@click.option('--max-pages', type=click.IntRange(min=0), default=50, show_default=True, help='Pages parsed per PDF at most (0: no limit)')
+@click.option('--token-budget', type=click.IntRange(min=0), default=10_000, show_default=True,
+              help='Stop parsing a PDF after this many tokens (0: no limit; ignored with --retrieval-k)')
+@click.option('--dry-run', is_flag=True, help='Only parse and tokenize: report projected tokens and cost per period, without calling the API')
+def main(data_root: Path, periods: tuple[str, ...], bank_sample: Optional[Path], output_dir: Path, model: Optional[str], cascade: bool, batch: bool,
+         retrieval_k: Optional[int], parse_workers: int, llm_workers: int, rpm: float, tpm: float, max_pages: int, token_budget: int, dry_run: bool):
 
     # Just to have pretty debugging messages...
     log_format = '<green>{time:HH:mm:ss.S}</green> | <level>{level: <8}</level> | <blue><level>{message}</level></blue>'
     logger.remove()
     logger.add(sys.stderr, format=log_format, colorize=True, level="DEBUG") # TRACE DEBUG INFO SUCCESS WARNING ERROR CRITICAL
-    
-    base_path = Path('C:/users/shawn/credit-cards-shawn/data/')
-    # TODO: iterate over periods
-    subfolder_names = [f.name for f in base_path.iterdir() if f.is_dir() and f.name.startswith('2')]
-
-    for period in subfolder_names:
-        process_period(period)
 
+    periods = list(periods) or sorted(f.name for f in data_root.iterdir() if f.is_dir() and f.name.startswith('2'))
+    if not periods:
+        raise click.UsageError(f'No periods found in "{data_root}"')
+    if batch and cascade:
+        raise click.UsageError('--batch and --cascade can\'t be combined (the cascade needs the cheap answers before deciding what to escalate)')
+    for period in periods:
+        if not (data_root / period).is_dir():
+            raise click.BadParameter(f'No folder "{period}" in "{data_root}"', param_hint='--period')
+    kwargs = dict(base_path=data_root, output_path=output_dir, bank_sample=None if bank_sample is None else read_bank_sample(bank_sample),
+                  model=model, batch=batch, retrieval_k=retrieval_k, cascade=cascade, parse_workers=parse_workers,
+                  max_pages=max_pages or None, token_budget=token_budget or None)
 
+    if dry_run:
+        df = estimate_periods(periods, **kwargs)
+        click.echo(df.to_string(index=False))
+        return
 
-if __name__ == '__main__':
-    main()
+    # All periods at once (shared workers, rate limit and cache)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    process_periods(periods, max_concurrency=llm_workers, rpm=rpm, tpm=tpm, **kwargs)
 
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Per-period manifest of the PDFs: path, size, mtime and sha256 of each file
+
+scan() compares the files against the manifest of the previous run and classifies them as "new",
+"changed" or "unchanged" in one pass; files whose size and mtime didn't change aren't hashed again.
+The scanned entries only replace the previous ones once their files are done (commit()), so a crash
+doesn't hide changed files; commit() saves the manifest every few seconds, and save() at the end.
+'''
+
+import json
+import time
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from utils import file_sha256
+
+
+@dataclass
+class ManifestEntry:
+    path: str # relative to the period folder, with forward slashes
+    size: int
+    mtime: float
+    sha256: str
+
+
+class Manifest:
+
+    def __init__(self, filename: Path, root: Path, save_interval: float = 5.0):
+        self.filename = filename
+        self.root = root
+        self.save_interval = save_interval # seconds between the saves of commit()
+        self.last_save = time.monotonic()
+        self.entries = {} # path -> ManifestEntry of the files done (previous runs and commit())
+        self.scanned = {} # path -> ManifestEntry of the files as they are now (see scan())
+        if self.filename.exists():
+            data = json.loads(self.filename.read_text(encoding='utf-8'))
+            self.entries = {entry['path']: ManifestEntry(**entry) for entry in data['files']}
+
+
+    def get_path(self, filename: Path) -> str:
+        return filename.relative_to(self.root).as_posix()
+
+
+    def scan(self, filenames: list[Path], workers: int = 4) -> dict[str, str]:
+        '''Returns the status of each file ("new", "changed" or "unchanged"), by path'''
+        stats = {self.get_path(fn): fn.stat() for fn in filenames}
+
+        # Hash only the files that are new or were touched (hashing is I/O bound, so threads are enough)
+        to_hash = [path for path, stat in stats.items()
+                   if path not in self.entries or (self.entries[path].size, self.entries[path].mtime) != (stat.st_size, stat.st_mtime)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = dict(zip(to_hash, executor.map(lambda path: file_sha256(self.root / path), to_hash)))
+
+        status = {}
+        for path, stat in stats.items():
+            previous = self.entries.get(path)
+            sha256 = hashes.get(path, previous.sha256 if previous else None)
+            if previous is None:
+                status[path] = 'new'
+            elif previous.sha256 != sha256:
+                status[path] = 'changed'
+            else:
+                status[path] = 'unchanged' # Possibly touched or copied, but same contents
+            self.scanned[path] = ManifestEntry(path, stat.st_size, stat.st_mtime, sha256)
+
+        counts = Counter(status.values())
+        logger.info(f'Manifest: {counts["new"]} new, {counts["changed"]} changed and {counts["unchanged"]} unchanged files ({len(to_hash)} hashed)')
+        return status
+
+
+    def get_sha256(self, filename: Path) -> str:
+        # Of a scanned file
+        return self.scanned[self.get_path(filename)].sha256
+
+
+    def commit(self, filenames: list[Path]):
+        # The files are done: their scanned entries replace the previous ones (saved every save_interval seconds)
+        for filename in filenames:
+            path = self.get_path(filename)
+            self.entries[path] = self.scanned[path]
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save()
+
+
+    def save(self):
+        # Write to a temporary file first, so a crash never leaves a half-written manifest
+        self.filename.parent.mkdir(exist_ok=True, parents=True)
+        data = {'root': str(self.root), 'files': [asdict(entry) for _, entry in sorted(self.entries.items())]}
+        tmp_fn = self.filename.with_name(self.filename.name + '.tmp')
+        tmp_fn.write_text(json.dumps(data, indent=1), encoding='utf-8')
+        tmp_fn.replace(self.filename)
+        self.last_save = time.monotonic()
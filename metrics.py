@@ -0,0 +1,159 @@
+'''
+Usage, cost and latency telemetry for LLM calls
+
+LLMMetrics is updated by LLM on every API call, cache lookup, retry and error; summary() returns
+a JSON-friendly dict (per model and totals) and write() saves it, e.g. once per period
+
+A period's metrics have the run's metrics as parent: questions asked with find_answer(metrics=...)
+are recorded in both
+'''
+
+import json
+import math
+import threading
+from pathlib import Path
+from collections import Counter, defaultdict
+from typing import Optional
+
+import numpy as np
+
+
+# US$ per 1m tokens (input, output); see: https://openai.com/pricing
+# The Batch API costs half of this
+PRICES = {
+    'gpt-4o-2024-05-13': (5.00, 15.00),
+    'gpt-4-turbo-2024-04-09': (10.00, 30.00),
+    'gpt-4-0613': (30.00, 60.00),
+    'gpt-3.5-turbo-0125': (0.50, 1.50),
+}
+BATCH_DISCOUNT = 0.5
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, math.inf)
+
+
+def get_cost(model: str, prompt_tokens: int, completion_tokens: int, batch: bool = False) -> Optional[float]:
+    # None if we don't know the model's price
+    if model not in PRICES:
+        return None
+    input_price, output_price = PRICES[model]
+    cost = (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+    return cost * BATCH_DISCOUNT if batch else cost
+
+
+class LLMMetrics:
+    '''Thread-safe counters; can be shared by several LLM objects (e.g. both models of a cascade)'''
+
+    def __init__(self, parent: Optional['LLMMetrics'] = None):
+        # parent: everything recorded here is also recorded there
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.calls = Counter() # model -> API calls (batch requests included)
+        self.batch_calls = Counter()
+        self.prompt_tokens = Counter()
+        self.completion_tokens = Counter()
+        self.cost = defaultdict(float)
+        self.unpriced_models = set()
+        self.latencies = defaultdict(list) # model -> seconds per successful call (not for batches)
+        self.retries = Counter()
+        self.errors = Counter() # error type -> count
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+    def record_call(self, model: str, prompt_tokens: int, completion_tokens: int, latency: Optional[float] = None, batch: bool = False):
+        cost = get_cost(model, prompt_tokens, completion_tokens, batch)
+        with self.lock:
+            self.calls[model] += 1
+            self.batch_calls[model] += batch
+            self.prompt_tokens[model] += prompt_tokens
+            self.completion_tokens[model] += completion_tokens
+            if cost is None:
+                self.unpriced_models.add(model)
+            else:
+                self.cost[model] += cost
+            if latency is not None:
+                self.latencies[model].append(latency)
+        if self.parent is not None:
+            self.parent.record_call(model, prompt_tokens, completion_tokens, latency, batch)
+
+
+    def record_cache(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        if self.parent is not None:
+            self.parent.record_cache(hit)
+
+
+    def record_retry(self, model: str):
+        with self.lock:
+            self.retries[model] += 1
+        if self.parent is not None:
+            self.parent.record_retry(model)
+
+
+    def record_error(self, error: str):
+        with self.lock:
+            self.errors[error] += 1
+        if self.parent is not None:
+            self.parent.record_error(error)
+
+
+    @property
+    def total_cost(self) -> float:
+        with self.lock:
+            return sum(self.cost.values())
+
+
+    def summary(self) -> dict:
+        with self.lock:
+            models = {}
+            for model in sorted(self.calls):
+                latencies = np.array(self.latencies[model])
+                # Bucket i holds LATENCY_BUCKETS[i - 1] < latency <= LATENCY_BUCKETS[i] (np.histogram's bins would be half-open the other way)
+                counts = np.bincount(np.searchsorted(LATENCY_BUCKETS, latencies, side='left'), minlength=len(LATENCY_BUCKETS))
+                models[model] = {
+                    'calls': self.calls[model],
+                    'batch_calls': self.batch_calls[model],
+                    'prompt_tokens': self.prompt_tokens[model],
+                    'completion_tokens': self.completion_tokens[model],
+                    'cost_usd': None if model in self.unpriced_models else round(self.cost[model], 6),
+                    'retries': self.retries[model],
+                    'latency': {
+                        'mean': float(latencies.mean()) if len(latencies) else None,
+                        'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                        'p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                        'max': float(latencies.max()) if len(latencies) else None,
+                        'histogram': {(f'<={bound}s' if bound < math.inf else f'>{LATENCY_BUCKETS[-2]}s'): int(count) for bound, count in zip(LATENCY_BUCKETS, counts)},
+                    },
+                }
+
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                'models': models,
+                'calls': sum(self.calls.values()),
+                'prompt_tokens': sum(self.prompt_tokens.values()),
+                'completion_tokens': sum(self.completion_tokens.values()),
+                'cost_usd': round(sum(self.cost.values()), 6),
+                'unpriced_models': sorted(self.unpriced_models),
+                'retries': sum(self.retries.values()),
+                'errors': dict(self.errors),
+                'cache': {'hits': self.cache_hits, 'misses': self.cache_misses, 'hit_ratio': self.cache_hits / lookups if lookups else None},
+            }
+
+
+    def write(self, filename: Path, **extra):
+        # extra: other JSON-friendly items to save along (e.g. period, cache stats)
+        filename.parent.mkdir(exist_ok=True, parents=True)
+        filename.write_text(json.dumps({**extra, **self.summary()}, indent=2), encoding='utf-8')
+
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        hit_ratio = summary['cache']['hit_ratio']
+        hit_ratio = 'n/a' if hit_ratio is None else f'{hit_ratio:.1%}'
+        return (f'{summary["calls"]} LLM calls; {summary["prompt_tokens"]:,} prompt + {summary["completion_tokens"]:,} completion tokens; '
+                f'${summary["cost_usd"]:.2f}; cache hit ratio {hit_ratio}; {summary["retries"]} retries; {sum(summary["errors"].values())} errors')
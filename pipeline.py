@@ -0,0 +1,123 @@
+'''
+Staged pipeline: documents are parsed in a process pool while the LLM answers the ones parsed before
+
+    jobs -> parse workers (processes) -> bounded queue -> LLM workers (async) -> results
+
+- Parsing is CPU bound (pdfplumber) and querying is network bound, so overlapping them keeps both busy
+- The queue holds at most `max_queued` parsed documents; when the LLM falls behind, parsing waits (backpressure)
+- Results are returned in the order of the jobs, whatever order documents finish in
+'''
+
+import asyncio
+import contextlib
+from pathlib import Path
+from typing import Optional, Callable
+from dataclasses import dataclass
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+from readers import PDF, Para, ParaCache, read_document
+from utils import file_sha256
+
+
+@dataclass
+class DocumentJob:
+    period: str
+    pdf_fn: Path
+    sha256: Optional[str] = None # From the manifest (saves hashing the file again)
+    error: Optional[str] = None # Why the document couldn't be parsed (its paragraphs are then empty)
+
+    @property
+    def bank_name(self) -> str:
+        return self.pdf_fn.parent.name
+
+    @property
+    def filename(self) -> str:
+        return self.pdf_fn.stem
+
+
+class Pipeline:
+
+    def __init__(self, llm, para_cache: ParaCache, parse_workers: int = 4, max_queued: int = 16, **parse_kwargs):
+        # llm: LLM or CascadeLLM (None: only parse, e.g. for batch mode)
+        # parse_kwargs: arguments of PDF.yield_paragraphs() (also part of the paragraph cache key)
+        self.llm = llm
+        self.para_cache = para_cache
+        self.parse_workers = parse_workers
+        self.max_queued = max_queued
+        self.parse_kwargs = parse_kwargs
+
+
+    def run(self, jobs: list[DocumentJob], prepare: Callable, finish: Callable) -> list:
+        '''
+        prepare(job, paras) returns the find_answer() arguments for a document (or None to not ask the LLM)
+        finish(job, paras, ans) returns the result of a document (ans is None if the LLM wasn't asked)
+
+        Both are called in this process, one document at a time; documents that fail to parse get them too,
+        with no paragraphs and job.error set (one bad PDF doesn't stop the others)
+        '''
+        if not jobs:
+            return []
+        return asyncio.run(self._run(jobs, prepare, finish))
+
+
+    async def _run(self, jobs: list[DocumentJob], prepare: Callable, finish: Callable) -> list:
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.max_queued)
+        results = [None] * len(jobs)
+        todo = iter(enumerate(jobs)) # Shared by the parse workers
+        num_llm_workers = 1 if self.llm is None else self.llm.max_concurrency
+
+        async def parse_worker(executor: ProcessPoolExecutor):
+            for i, job in todo:
+                try:
+                    paras = await self._parse(loop, executor, job)
+                except Exception as e:
+                    logger.opt(exception=e).error(f'Could not parse "{job.pdf_fn}"')
+                    job.error = f'{type(e).__name__}: {e}'
+                    paras = []
+                await queue.put((i, job, paras)) # Blocks while the queue is full
+
+        async def llm_worker():
+            while (item := await queue.get()) is not None:
+                i, job, paras = item
+                request = prepare(job, paras)
+                ans = None
+                if request is not None and self.llm is not None:
+                    ans = await self.llm.find_answer_async(**request)
+                results[i] = finish(job, paras, ans)
+
+        async def parse_all(executor: ProcessPoolExecutor):
+            await asyncio.gather(*(parse_worker(executor) for _ in range(self.parse_workers)))
+            for _ in range(num_llm_workers):
+                await queue.put(None) # Tell the LLM workers we are done
+
+        session = contextlib.nullcontext() if self.llm is None else self.llm.async_session()
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as executor:
+            async with session:
+                tasks = [asyncio.create_task(parse_all(executor))] + [asyncio.create_task(llm_worker()) for _ in range(num_llm_workers)]
+                # If any stage fails, stop the others instead of waiting on a queue forever
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                for task in done:
+                    task.result()
+
+        logger.info(f'Pipeline done: {len(jobs)} documents')
+        return results
+
+
+    async def _parse(self, loop: asyncio.AbstractEventLoop, executor: ProcessPoolExecutor, job: DocumentJob) -> list[Para]:
+        # Paragraph cache first; only misses go to the process pool
+        # Hashing and cache reads/writes (which commit) block, so they run in threads, not on the event loop the LLM workers share
+        pdf = PDF(job.pdf_fn)
+        sha256 = job.sha256 if job.sha256 is not None else await loop.run_in_executor(None, file_sha256, job.pdf_fn)
+        paras = await loop.run_in_executor(None, partial(self.para_cache.get_cached, pdf, sha256=sha256, **self.parse_kwargs))
+        if paras is None:
+            pdf = await loop.run_in_executor(executor, partial(read_document, job.pdf_fn, **self.parse_kwargs))
+            paras = pdf.paragraphs
+            await loop.run_in_executor(None, partial(self.para_cache.put, pdf, paras, sha256=sha256, **self.parse_kwargs))
+        return paras
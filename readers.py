@@ -5,12 +5,15 @@ Code that ingests/reads data from different sources
 Tools:
 
 - PDF: pdfplumber (although pymupdf is faster)
+  backend='pymupdf' uses PyMuPDF for text, falling back to pdfplumber on pages that might have tables
 '''
 
 import re
+import gc
 from typing import Optional # Any, 
-from collections.abc import Generator
-from collections import defaultdict
+from collections.abc import Generator, Iterable
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from dataclasses import dataclass
 from pathlib import Path
@@ -19,12 +22,15 @@ from tqdm import tqdm
 from loguru import logger
 import pdfplumber
 from sqlitedict import SqliteDict
+import numpy as np
 
-# Table extraction
-import pandas as pd
-from py_markdown_table.markdown_table import markdown_table
+# Optional faster backend
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
 
-from utils import normalize_text_for_embedding
+from utils import normalize_text_for_embedding, file_sha256, count_tokens, get_rss_mb
 
 
 
@@ -39,6 +45,14 @@ class Para:
     raw_text: Optional[str] = None
 
 
+@dataclass
+class ParsedPage:
+    page: int
+    paras: list[Para]
+    tables: list[Para]
+    skipped_table_search: bool = False # True if the page was ruled out by may_contain_table()
+
+
 class PDF:
     '''Extract text from PDF using pdfplumber'''
 
@@ -51,150 +65,438 @@ class PDF:
         self.table_positions = defaultdict(list)
 
 
-    def yield_paragraphs(self, detect_tables=False, inspect=False) -> Generator[Para, None, None]:
+    def yield_paragraphs(
+            self,
+            detect_tables=False,
+            inspect=False,
+            max_pages: Optional[int] = 50,
+            y_density: float = 13.8,
+            backend: str = 'pdfplumber',
+            token_budget: Optional[int] = None,
+            max_memory_mb: Optional[float] = None,
+            workers: Optional[int] = None
+        ) -> Generator[Para, None, None]:
         # A PDF can have 1000+ pages
         # For performance, we will parse each page at a time and then yield the paragraphs
         # Note: if we pass "laparams= {}" we can retrieve more objects
 
         # If detect_tables=True, we will yield the corresponding text as tables instead of paras
 
+        # backend='pymupdf' is several times faster; pages with drawings (potential tables) are still
+        # parsed with pdfplumber if detect_tables=True
+
+        # The LLM only sees the first ~10k tokens, so with token_budget we stop opening new pages once
+        # the paragraphs yielded so far add up to that many tokens (max_pages is then just a fallback)
+
+        # Each page's layout objects are released once the page is parsed; pdfminer still keeps some
+        # state for the whole document (decoded streams, fonts) so with max_memory_mb the document is
+        # reopened whenever the RSS of the process goes above that (see iter_pages)
+
+        # If workers > 1, the pages are split into contiguous chunks that are parsed by a process pool
+        # (each worker opens the PDF on its own, as pdfplumber pages can't be pickled)
+        # Results are consumed in page order, so the output is identical to the sequential run
+
         # Note that we can access tables as lists with either:
         # a) page.extract_tables(table_settings={})
         # b) tables = page.find_tables(table_settings={})
         #    tables[0].extract()
         # The second is slower if we only want the text but useful if we also want the bbox
         
-        with pdfplumber.open(self.filename) as pdf:
-            logger.info(f' - Reading text from PDF ({len(pdf.pages)} pages)')
+        assert backend in ('pdfplumber', 'pymupdf'), backend
+        assert backend != 'pymupdf' or pymupdf is not None, 'PyMuPDF is not installed'
+        kwargs = dict(detect_tables=detect_tables, inspect=inspect, y_density=y_density, backend=backend,
+                      max_memory_mb=max_memory_mb)
+
+        doc = open_document(self.filename, backend)
+        try:
+            self.num_pages = count_pages(doc)
+            logger.info(f' - Reading text from PDF ({self.num_pages} pages)')
             
-            self.metadata = pdf.metadata.copy()
-            self.num_pages = len(pdf.pages)
+            self.metadata = doc.metadata.copy()
             self.num_paragraphs = 0
             self.num_tables = 0
+            self.num_table_searches_skipped = 0
+            self.num_pages_read = 0
+            self.num_tokens = 0
+
+            # Experimental - Only read first 100? 50? pages (max_pages=None reads the whole document)
+            last_page = self.num_pages if max_pages is None else min(self.num_pages, max_pages)
+        except:
+            doc.close()
+            raise
+
+        if workers is None or workers <= 1:
+            # iter_pages() takes over the open document (it might reopen it to free memory)
+            yield from self._consume(iter_pages(self.filename, 1, last_page, doc=doc, **kwargs), token_budget)
+            self._log_skipped(detect_tables)
+            return
+        doc.close()
+
+        # Parallel mode: split pages into ~2 chunks per worker (to balance slow pages)
+        chunk_size = max(1, -(-last_page // (2 * workers)))
+        chunks = [(first, min(first + chunk_size - 1, last_page)) for first in range(1, last_page + 1, chunk_size)]
+        fn = partial(_read_page_range, self.filename, **kwargs)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed_pages = (parsed_page for chunk in executor.map(fn, *zip(*chunks)) for parsed_page in chunk)
+            yield from self._consume(parsed_pages, token_budget)
+            # If we stopped early, don't wait for chunks that haven't started yet
+            executor.shutdown(cancel_futures=True)
+        self._log_skipped(detect_tables)
+
+
+    def _consume(self, parsed_pages: Iterable[ParsedPage], token_budget: Optional[int] = None) -> Generator[Para, None, None]:
+        # Yield all paras and then all tables of each page, updating the counters
+        # Stop after the page where the token budget was reached (if any)
+        for parsed_page in parsed_pages:
+            self.num_pages_read += 1
+            self.num_table_searches_skipped += parsed_page.skipped_table_search
+            for para in parsed_page.paras:
+                para.position = self.num_paragraphs + self.num_tables
+                self.num_paragraphs += 1
+                yield para
+            for table in parsed_page.tables:
+                table.position = self.num_paragraphs + self.num_tables
+                self.num_tables += 1
+                yield table
+
+            if token_budget is not None:
+                # +1 for the paragraph separator in the context
+                self.num_tokens += sum(count_tokens(para.text) + 1 for para in parsed_page.paras + parsed_page.tables)
+                if self.num_tokens >= token_budget:
+                    logger.info(f' - Token budget reached after page {parsed_page.page} ({self.num_tokens} tokens)')
+                    return
 
-            #for page in tqdm(pdf.pages):
-            for page in pdf.pages:
 
-                page_num = page.page_number
+    def _log_skipped(self, detect_tables: bool):
+        if detect_tables:
+            logger.info(f' - Skipped table search on {self.num_table_searches_skipped} of {self.num_pages_read} pages (no ruling lines)')
 
-                # Steps:
-                # 1) Identify tables so we can exclude text contained in them (that would otherwise be duplicated)
-                # 2) Transform tables to text; store them
-                # 4) Determine if we want to abort a page
-                # 5) Yield all paras (unless we abort a para)
-                # 6) Yield all tables
 
-                # Experimental - Only read first 100? 50? pages
-                if page_num > 50:
-                    return
+class ParaCache:
+    '''
+    Persistent cache of parsed paragraphs
+
+    Keys are the sha256 of the PDF contents plus the parser settings that affect the output,
+    so renamed/moved files are still hits and changing e.g. max_pages invalidates the entry
+    '''
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        logger.info(f'Connecting to paragraph cache "{self.filename}"')
+        self.cache_db = SqliteDict(str(self.filename))
+
+
+    @staticmethod
+    def get_key(filename: Path, detect_tables=False, inspect=False, max_pages: Optional[int] = 50, y_density: float = 13.8,
+                backend: str = 'pdfplumber', token_budget: Optional[int] = None, sha256: Optional[str] = None) -> str:
+        # sha256: hash of the file if already known (e.g. from a manifest)
+        sha256 = file_sha256(filename) if sha256 is None else sha256
+        key = f'{sha256}|tables={detect_tables}|inspect={inspect}|pages={max_pages}|y_density={y_density}'
+        # Keep keys of the default settings unchanged
+        if backend != 'pdfplumber':
+            key += f'|backend={backend}'
+        if token_budget is not None:
+            key += f'|tokens={token_budget}'
+        return key
+
+
+    def get_cached(self, pdf: PDF, sha256: Optional[str] = None, **kwargs) -> Optional[list[Para]]:
+        # None if the paragraphs aren't in the cache
+        cached = self.cache_db.get(self.get_key(pdf.filename, sha256=sha256, **kwargs))
+        if cached is None:
+            return None
+
+        logger.info('     Loading paragraphs from cache')
+        # Restore the attributes that yield_paragraphs() would have set
+        pdf.metadata = cached['metadata']
+        pdf.num_pages = cached['num_pages']
+        pdf.num_paragraphs = cached['num_paragraphs']
+        pdf.num_tables = cached['num_tables']
+        pdf.num_table_searches_skipped = cached.get('num_table_searches_skipped', 0)
+        return cached['paras']
+
+
+    def put(self, pdf: PDF, paras: list[Para], sha256: Optional[str] = None, **kwargs):
+        # Store the paragraphs of a parsed PDF (kwargs are the parser settings used)
+        key = self.get_key(pdf.filename, sha256=sha256, **kwargs)
+        self.cache_db[key] = {
+            'paras': paras,
+            'metadata': pdf.metadata,
+            'num_pages': pdf.num_pages,
+            'num_paragraphs': pdf.num_paragraphs,
+            'num_tables': pdf.num_tables,
+            'num_table_searches_skipped': pdf.num_table_searches_skipped,
+        }
+        self.cache_db.commit()
+
+
+    def close(self):
+        self.cache_db.close()
+
+
+def read_page(page, detect_tables=False, inspect=False, y_density: float = 13.8) -> ParsedPage:
+    '''Parse a single pdfplumber page into paragraphs and tables'''
+
+    page_num = page.page_number
+
+    # Steps:
+    # 1) Identify tables so we can exclude text contained in them (that would otherwise be duplicated)
+    # 2) Transform tables to text; store them
+    # 4) Determine if we want to abort a page
+    # 5) Yield all paras (unless we abort a para)
+    # 6) Yield all tables
+
+    converted_tables = []
+    skipped_table_search = detect_tables and not may_contain_table(page)
+    if detect_tables and not skipped_table_search:
+        tables = page.find_tables(table_settings={})
+        if tables:
+            # Get the bounding boxes of the tables on the page.
+            # See: https://github.com/jsvine/pdfplumber/issues/242#issuecomment-1686505282
+            bboxes = [table.bbox for table in tables]
+
+            # Filter-out tables from page (so .extract_text() below won't include them)
+            page = exclude_bboxes(page, bboxes)
+
+            #logger.info(f'    - Identified {len(tables)} table on page {page_num})')
+            for table in tables:
+                table = table.extract() # x_tolerance=3, y_tolerance=3 -> defaults
+                md = table_to_markdown(table)
+
+                # No point in keeping empty tables
+                if md is None:
+                    continue
+
+                para = Para(page=page_num, is_table=True, text=md)
+                converted_tables.append(para)
+
+    #print(page.objects.keys())
+    # Default y_density is 13; but that sometimes splits paragraphs
+    # Not fully sure how this algorithm works though...
+    # https://github.com/jsvine/pdfplumber/blob/stable/pdfplumber/utils/text.py
+    text = page.extract_text(layout=True, y_density=y_density)
+    text = clean_text(text)
+    raw_text = text if inspect else None
+    paras = [Para(page=page_num, is_table=False, text=para, raw_text=raw_text)
+             for para in text2paragraphs(text) if not abort_para(para)]
+
+    return ParsedPage(page=page_num, paras=paras, tables=converted_tables, skipped_table_search=skipped_table_search)
+
+
+def table_to_markdown(table: list[list[Optional[str]]]) -> Optional[str]:
+    '''
+    Convert a table (list of rows, as returned by table.extract()) into a markdown table
+
+    Try to make markdown tables as close as possible to what OpenAI expects: the first row is the header,
+    empty columns are dropped and cells are centered (extra space on the left), matching the output we
+    used to get from pandas + py_markdown_table with the header row swapped in
+    '''
+    rows = [['' if c is None else c.replace('\n', ' ').strip() for c in row] for row in table]
+    if not rows:
+        return None
+
+    num_cols = max(len(row) for row in rows)
+    rows = [row + [''] * (num_cols - len(row)) for row in rows]
+    cols = [j for j in range(num_cols) if any(row[j] for row in rows)]
+    if not cols:
+        return None
+
+    # Columns are at least as wide as their old placeholder names ("C1", "C2", ...)
+    widths = [max(len(f'C{j+1}'), max(len(row[j]) for row in rows)) for j in cols]
+
+    lines = []
+    for row in rows:
+        line = []
+        for j, width in zip(cols, widths):
+            margin = width - len(row[j])
+            line.append(' ' * (margin - margin // 2) + row[j] + ' ' * (margin // 2))
+        lines.append('|' + '|'.join(line) + '|')
+
+    separator = '|' + '|'.join('-' * width for width in widths) + '|'
+    return '\n'.join([lines[0], separator] + lines[1:])
+
+
+def may_contain_table(page) -> bool:
+    '''
+    Cheap test that rules out pages where page.find_tables(table_settings={}) can't find anything
+
+    The default "lines" strategy builds cells out of ruling edges (from line, rect and curve objects),
+    and any cell needs at least two vertical and two horizontal edges, so pages of plain prose
+    (no drawings at all) are skipped without running the table finder
+    '''
+    objects = page.objects
+    if not any(objects.get(kind) for kind in ('line', 'rect', 'curve')):
+        return False
+
+    # Same length filter as pdfplumber's filter_edges() (min_length=1)
+    num_v = num_h = 0
+    for edge in page.edges:
+        if edge['orientation'] == 'v':
+            num_v += edge['height'] >= 1
+        else:
+            num_h += edge['width'] >= 1
+        if num_v >= 2 and num_h >= 2:
+            return True
+    return False
 
-                converted_tables = []
-                if detect_tables:
-                    tables = page.find_tables(table_settings={})
-                    if tables:
-                        # Get the bounding boxes of the tables on the page.
-                        # See: https://github.com/jsvine/pdfplumber/issues/242#issuecomment-1686505282
-                        bboxes = [table.bbox for table in tables]
-                        bbox_not_within_bboxes = partial(not_within_bboxes, bboxes=bboxes)
-
-                        # Filter-out tables from page (so .extract_text() below won't include them)
-                        page = page.filter(bbox_not_within_bboxes)
-
-                        #logger.info(f'    - Identified {len(tables)} table on page {page_num})')
-                        for table in tables:
-                            table = table.extract() # x_tolerance=3, y_tolerance=3 -> defaults
-                            # Convert table to markdown
-                            table = [['' if c is None else c.replace('\n', ' ').strip() for c in row] for row in table]
-                            df = pd.DataFrame(table)
-                            empty_cols = [df[col].name for col in df if not df[col].any()]
-                            df.drop(empty_cols, axis=1, inplace=True)
-                            df.rename(columns = {x: "C"+str(x+1) for x in range(0,240)}, inplace = True)
-                            data = df.to_dict(orient='records')
-
-                            # markdown_table fails if data is empty (and there's no point in parsing it anyways)
-                            if not data:
-                                continue
-
-                            try:
-                                # Try to make markdown tables as close as possible to what OpenAI expects
-                                md_table = markdown_table(data).set_params(row_sep='markdown', quote=False)
-                                md = md_table.get_markdown()
-                                md = md.split('\n')
-                                md = [md[2], md[1]] + md[3:]
-                                md = '\n'.join(md)
-                            except:
-                                # What if some assumptions (e.g. number of rows) are not met? Easy hack/fix
-                                #md = markdown_table(data).get_body()
-                                md = markdown_table(data).get_markdown()
-                            
-                            para = Para(page=page_num, is_table=True, text=md)
-                            converted_tables.append(para)
-
-                #print(page.objects.keys())
-                # Default y_density is 13; but that sometimes splits paragraphs
-                # Not fully sure how this algorithm works though...
-                # https://github.com/jsvine/pdfplumber/blob/stable/pdfplumber/utils/text.py
-                text = page.extract_text(layout=True, y_density=13.8)
-                text = clean_text(text)
-                raw_text = text if inspect else None
-                paras = text2paragraphs(text)
-
-                for para in paras:
-                    if abort_para(para):
-                        continue
-                    self.num_paragraphs += 1
-                    yield Para(page=page_num, is_table=False, text=para, raw_text=raw_text)
-
-                for table in converted_tables:
-                    self.num_tables += 1
-                    yield table
+
+def read_page_pymupdf(page, inspect=False) -> list[Para]:
+    '''Parse a single PyMuPDF page into paragraphs (no table detection)'''
+
+    # Text blocks are (roughly) paragraphs, so separate them with empty lines
+    # as extract_text(layout=True) does with vertical gaps
+    blocks = page.get_text('blocks', sort=True)
+    text = '\n\n'.join(block[4] for block in blocks if block[6] == 0) # block_type=0 -> text
+    text = clean_text(text)
+    raw_text = text if inspect else None
+    page_num = page.number + 1
+    return [Para(page=page_num, is_table=False, text=para, raw_text=raw_text)
+            for para in text2paragraphs(text) if not abort_para(para)]
+
+
+def has_drawings(page) -> bool:
+    '''True if a PyMuPDF page has lines or rectangles (i.e. might contain a ruled table)'''
+    return any(item[0] in ('l', 're', 'qu') for path in page.get_drawings() for item in path['items'])
+
+
+def open_document(filename: Path, backend: str = 'pdfplumber'):
+    return pymupdf.open(filename) if backend == 'pymupdf' else pdfplumber.open(filename)
+
+
+def count_pages(doc) -> int:
+    return doc.page_count if pymupdf is not None and isinstance(doc, pymupdf.Document) else len(doc.pages)
+
+
+def iter_pages(filename: Path, first: int, last: int, backend: str = 'pdfplumber', detect_tables=False, inspect=False,
+               y_density: float = 13.8, max_memory_mb: Optional[float] = None, doc=None) -> Generator[ParsedPage, None, None]:
+    '''
+    Yield the parsed pages first..last (1-based, inclusive) of a PDF
+
+    Pass `doc` to reuse a document already opened with `backend` (it will be closed here)
+    '''
+
+    # Open documents by backend; with PyMuPDF, pdfplumber is opened lazily for pages that might contain tables
+    docs = {} if doc is None else {backend: doc}
+    memory_limit = max_memory_mb
+
+    def get_doc(name: str):
+        if name not in docs:
+            docs[name] = open_document(filename, name)
+        return docs[name]
+
+    def close_docs():
+        for open_doc in docs.values():
+            open_doc.close()
+        docs.clear()
+
+    try:
+        #for page_num in tqdm(range(first, last + 1)):
+        for page_num in range(first, last + 1):
+            parsed_page = None
+            if backend == 'pymupdf':
+                page = get_doc('pymupdf')[page_num - 1]
+                if not (detect_tables and has_drawings(page)):
+                    paras = read_page_pymupdf(page, inspect=inspect)
+                    parsed_page = ParsedPage(page=page_num, paras=paras, tables=[], skipped_table_search=detect_tables)
+
+            if parsed_page is None:
+                page = get_doc('pdfplumber').pages[page_num - 1]
+                parsed_page = read_page(page, detect_tables=detect_tables, inspect=inspect, y_density=y_density)
+                # We won't come back to this page, so release its layout objects
+                page.close()
+
+            yield parsed_page
+
+            # Reopening the document drops whatever pdfminer/MuPDF cached for the pages read so far
+            rss = get_rss_mb() if memory_limit is not None else None
+            if rss is not None and rss > memory_limit:
+                close_docs()
+                gc.collect()
+                new_rss = get_rss_mb()
+                logger.info(f'    - Memory at {rss:.0f}MB after page {page_num}; reopened PDF ({new_rss:.0f}MB)')
+                # The allocator doesn't always return memory to the OS; don't reopen again on every page
+                memory_limit = max(max_memory_mb, 1.1 * new_rss)
+    finally:
+        close_docs()
+
+
+def _read_page_range(filename: Path, first: int, last: int, **kwargs) -> list[ParsedPage]:
+    # Worker function for the process pool (needs to be top-level so it can be pickled)
+    return list(iter_pages(filename, first, last, **kwargs))
+
+
+def read_document(filename: Path, **kwargs) -> PDF:
+    # Worker function for yield_documents() (and pipeline.py); returns the PDF object with its paragraphs attached
+    pdf = PDF(filename)
+    pdf.paragraphs = list(pdf.yield_paragraphs(**kwargs))
+    return pdf
+
+
+def yield_documents(filenames: list[Path], workers: int = 4, max_pending: Optional[int] = None, **kwargs) -> Generator[PDF, None, None]:
+    '''
+    Parse many PDFs in parallel (one document per worker)
+
+    Yields PDF objects in the same order as `filenames`, with the parsed paragraphs stored in pdf.paragraphs
+    At most `max_pending` documents are parsed ahead of the consumer (default: 2 per worker)
+    '''
+    max_pending = 2 * workers if max_pending is None else max_pending
+    fn = partial(read_document, **kwargs)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for filename in filenames:
+            pending.append(executor.submit(fn, filename))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Text normalization runs on every page, so compile patterns once
+quotes_table = str.maketrans({
+    '\u201f': '"',  # double high-reversed-9 quotation mark
+    '\u201c': '"',  # left double quotation mark
+    '\u201d': '"',  # right double quotation mark
+    '’': "'",
+})
+re_cid_garbage = re.compile(r'(\(cid:\d+\)){2,}')
+re_cid_bullet = re.compile(r'\s\(cid:\d+\) ')
+re_blank_lines = re.compile(r'\n\s*\n')  # a line with only whitespace ends a paragraph
+re_spaces = re.compile(r'\s{2,}')
 
 
 def clean_text(text: str) -> str:
-    text = text.replace(u'\u201f', '"')  # double high-reversed-9 quotation mark
-    text = text.replace(u'\u201c', '"')  # left double quotation mark
-    text = text.replace(u'\u201d', '"')  # right double quotation mark
-    text = text.replace(u'’', "'")
-    
+    text = text.translate(quotes_table)
+
     # PDF garbled text that we need to delete (else GPT stops due to repeated patterns)
-    # 1) This is usually bar plots or other charts represented as text in older PDFs
-    text = re.sub(r'(\(cid:\d+\)){2,}', "", text)  # Bullet symbol
-    # 2) Bullet symbols
-    text = re.sub(r'\s\(cid:\d+\) ', "- ", text)  # The number could be 1, 2, 130, 190, 216, etc.
+    if '(cid:' in text:
+        # 1) This is usually bar plots or other charts represented as text in older PDFs
+        text = re_cid_garbage.sub("", text)
+        # 2) Bullet symbols
+        text = re_cid_bullet.sub("- ", text)  # The number could be 1, 2, 130, 190, 216, etc.
     # 3) Sanity check
     #assert '(cid:' not in text, text
 
     return text
 
 
-def text2paragraphs(text: str) -> list[str]:
-    new_para: str
-    paras: list[str] = []
-    # add empty str at the end to finalize last paragraph
-    lines = [fix_line(line) for line in text.split('\n')] + ['']
-    parts: list[str] = []
-    for line in lines:
-        if not line and parts:
-            new_para = ' '.join(parts)
-            if '\uf0b7' in new_para:
-                new_para = fix_bullet_list(new_para)
-            paras.append(new_para)
-            parts = []
-        elif line:
-            parts.append(line)
+def text2paragraphs(text: str) -> Generator[str, None, None]:
+    # Paragraphs are separated by empty lines; their lines are stripped and joined with spaces
+    # (done on the whole block at once: newlines become spaces and runs of whitespace collapse)
+    # We hold back one paragraph so we can drop the page number at the end of the page
+    prev_para = None
+    for block in re_blank_lines.split(text):
+        para = re_spaces.sub(' ', block.replace('\n', ' ')).strip()
+        if not para:
+            continue
+        if '\uf0b7' in para:
+            para = fix_bullet_list(para)
+        if prev_para is not None:
+            yield prev_para
+        prev_para = para
 
     # Remove page number at the end of the page
-    if paras and paras[-1].isdigit():
-        paras = paras[:-1]
-    
-    return paras
-
-
-def fix_line(text: str) -> str:
-    text = text.strip()
-    text = re.sub(r'\s{2,}', ' ', text)
-    text = text.replace('”', '"').replace('“', '"')
-    return text
+    if prev_para is not None and not prev_para.isdigit():
+        yield prev_para
 
 
 def fix_bullet_list(text: str) -> str:
@@ -237,21 +539,29 @@ def abort_para(para: str) -> bool:
     return False
 
 
-def not_within_bboxes(obj, bboxes):
-    """Check if the object is in any of the table's bbox."""
-    # SOURCE: https://github.com/jsvine/pdfplumber/issues/242#issuecomment-1686505282
-
-    def obj_in_bbox(_bbox):
-        """Define objects in box.
-
-        See https://github.com/jsvine/pdfplumber/blob/stable/pdfplumber/table.py#L404
-        """
-        v_mid = (obj["top"] + obj["bottom"]) / 2
-        h_mid = (obj["x0"] + obj["x1"]) / 2
-        x0, top, x1, bottom = _bbox
-        return (h_mid >= x0) and (h_mid < x1) and (v_mid >= top) and (v_mid < bottom)
+def exclude_bboxes(page, bboxes: list[tuple[float, float, float, float]]):
+    """
+    Filter out of the page all objects whose midpoint falls within any of the (table) bboxes
 
-    return not any(obj_in_bbox(__bbox) for __bbox in bboxes)
+    Same as page.filter() with a per-object test, but the midpoints of all objects are checked
+    against all bboxes at once with NumPy, so the filter itself is just a set lookup
+    """
+    # SOURCE: https://github.com/jsvine/pdfplumber/issues/242#issuecomment-1686505282
+    # Objects "in" a bbox are defined as in https://github.com/jsvine/pdfplumber/blob/stable/pdfplumber/table.py#L404
+    x0, top, x1, bottom = np.array(bboxes, dtype=float).T[:, :, None] # shape (num_bboxes, 1) each
+
+    excluded = set()
+    for objs in page.objects.values():
+        if not objs:
+            continue
+        coords = np.array([(obj['x0'], obj['top'], obj['x1'], obj['bottom']) for obj in objs], dtype=float).T
+        h_mid = (coords[0] + coords[2]) / 2
+        v_mid = (coords[1] + coords[3]) / 2
+        inside = ((h_mid >= x0) & (h_mid < x1) & (v_mid >= top) & (v_mid < bottom)).any(axis=0)
+        excluded.update(id(obj) for obj, is_inside in zip(objs, inside) if is_inside)
+
+    # FilteredPage tests the parent page's own object dicts, so their ids are stable
+    return page.filter(lambda obj: id(obj) not in excluded)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+'''
+Offline stand-ins for the OpenAI client, to benchmark the pipeline without network or API costs
+
+Answers come from a recorded answer cache (same keys as LLM uses) or, for prompts that weren't
+recorded, from the deterministic generator of fake_openai.py. Latency is log-normal and errors are
+drawn from per-type rates, so concurrency, retries, caching and rate limiting can be load-tested.
+
+Usage:
+    llm = LLM(cache=..., **replay_clients(recorded=AnswerCache(...), latency=0.8, error_rates={'rate_limit': 0.02}))
+'''
+
+import math
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from types import SimpleNamespace
+from typing import Optional
+
+import openai
+from openai.types.chat import ChatCompletion
+
+from cache import AnswerCache
+from fake_openai import synthetic_completion
+from utils import count_tokens
+
+
+ERROR_TYPES = ('rate_limit', 'server_error', 'timeout')
+
+
+class ReplayClient:
+    '''
+    Implements client.chat.completions.create() (the only call LLM makes per question)
+
+    - recorded: cache with answers from earlier runs; unknown prompts get synthetic answers (or raise if strict)
+    - latency, latency_sigma: median seconds per request and log-normal spread (0 = constant)
+    - error_rates: e.g. {'rate_limit': 0.02, 'server_error': 0.01, 'timeout': 0.005}
+    - truncate_rate: fraction of answers cut off with finish_reason="length"
+    '''
+
+    def __init__(
+            self,
+            recorded: Optional[AnswerCache] = None,
+            latency: float = 0.0,
+            latency_sigma: float = 0.0,
+            error_rates: Optional[dict] = None,
+            truncate_rate: float = 0.0,
+            strict: bool = False,
+            seed: int = 0
+        ):
+        self.recorded = recorded
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rates = {} if error_rates is None else error_rates
+        assert set(self.error_rates) <= set(ERROR_TYPES), f'Error types must be in {ERROR_TYPES}'
+        self.truncate_rate = truncate_rate
+        self.strict = strict
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'recorded': 0, 'synthetic': 0, 'errors': 0, 'truncated': 0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+
+    def create(self, **request) -> ChatCompletion:
+        delay, result = self._respond(request)
+        time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def close(self):
+        pass
+
+
+    def _respond(self, request: dict) -> tuple[float, object]:
+        # Returns the delay and the response (or the exception to raise)
+        with self.lock:
+            self.stats['requests'] += 1
+            delay = self.latency
+            if self.latency > 0 and self.latency_sigma > 0:
+                delay = self.rng.lognormvariate(math.log(self.latency), self.latency_sigma)
+
+            draw = self.rng.random()
+            for error_type, rate in self.error_rates.items():
+                if draw < rate:
+                    self.stats['errors'] += 1
+                    return delay, make_error(error_type)
+                draw -= rate
+            truncate = self.rng.random() < self.truncate_rate
+
+        answer = self._get_recorded(request)
+        with self.lock:
+            self.stats['recorded' if answer is not None else 'synthetic'] += 1
+            self.stats['truncated'] += truncate
+        if answer is None and self.strict:
+            return delay, make_error('not_found')
+
+        response = synthetic_completion(request, truncate=truncate, answer=answer)
+        # Token counts as the real API would report them (roughly: the chat format adds a few tokens per message)
+        prompt_tokens = sum(count_tokens(message['content']) + 4 for message in request['messages'])
+        completion_tokens = count_tokens(response['choices'][0]['message']['content'])
+        response['usage'] = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+        return delay, ChatCompletion.model_validate(response)
+
+
+    def _get_recorded(self, request: dict) -> Optional[dict]:
+        # Same key as LLM._get_key()
+        if self.recorded is None:
+            return None
+        full_question = next(message['content'] for message in request['messages'] if message['role'] == 'user')
+        augmented_question = full_question + '\n' + f'INFO: llm={request["model"]}'
+        ans = self.recorded.get(hashlib.sha256(augmented_question.encode('utf-8')).hexdigest())
+        if ans is None:
+            return None
+        return {k: v for k, v in ans.items() if k not in ('usage', 'source', 'llm', 'temperature')}
+
+
+class AsyncReplayClient(ReplayClient):
+    '''Same as ReplayClient for the async code path (LLM.find_answers)'''
+
+    async def create(self, **request) -> ChatCompletion:
+        delay, result = self._respond(request)
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    async def close(self):
+        pass
+
+
+def make_error(error_type: str) -> Exception:
+    # The same exceptions the OpenAI client raises; the exceptions only read these attributes of the
+    # request and response, so we don't need the client's HTTP library (its name depends on the openai version)
+    request = SimpleNamespace(method='POST', url='https://replay.invalid/v1/chat/completions')
+    if error_type == 'timeout':
+        return openai.APITimeoutError(request=request)
+    status, cls = {'rate_limit': (429, openai.RateLimitError), 'server_error': (500, openai.InternalServerError),
+                   'not_found': (404, openai.NotFoundError)}[error_type]
+    body = {'message': f'Replayed {error_type} error', 'type': error_type}
+    response = SimpleNamespace(status_code=status, headers={}, request=request)
+    return cls(body['message'], response=response, body=body)
+
+
+def replay_clients(**kwargs) -> dict:
+    '''Sync and async clients sharing the same recording and settings, as keyword arguments for LLM()'''
+    client = ReplayClient(**kwargs)
+    async_client = AsyncReplayClient(**kwargs)
+    async_client.rng = client.rng # Share the random stream, so runs are reproducible whichever path is used
+    async_client.lock = client.lock
+    async_client.stats = client.stats
+    return dict(client=client, async_client=async_client)
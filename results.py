@@ -0,0 +1,112 @@
+'''
+Per-document results of process_period, saved as soon as each document is done
+
+SQLite (WAL); every put() is its own transaction, so a crash loses at most the documents in flight.
+Resuming is a key lookup (keys()), and the {period}-data.tsv table is exported from here at the end.
+Each result keeps the sha256 of its PDF (hashes()), so a run can tell whether a file changed since,
+even without a manifest (e.g. after a crash); results imported from TSV files have none.
+'''
+
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+from loguru import logger
+
+
+class ResultStore:
+
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self.lock = threading.Lock()
+        logger.info(f'Saving results to "{self.filename}"')
+        self.conn = sqlite3.connect(str(self.filename), timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS results (
+            period TEXT, bank_name TEXT, filename TEXT, source TEXT, data TEXT, updated REAL, sha256 TEXT,
+            PRIMARY KEY (period, bank_name, filename))''')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(results)')]
+        if 'sha256' not in columns:
+            self.conn.execute('ALTER TABLE results ADD COLUMN sha256 TEXT') # Stores created before results had hashes
+        self.conn.commit()
+
+
+    def put(self, period: str, ans: dict, sha256: Optional[str] = None):
+        # ans must have the bank_name and filename fields; sha256 is the hash of the PDF the answer is for
+        data = json.dumps(ans, default=str)
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (period, ans['bank_name'], ans['filename'], ans.get('source'), data, time.time(), sha256))
+
+
+    def get(self, period: str, bank_name: str, filename: str):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM results WHERE period=? AND bank_name=? AND filename=?', (period, bank_name, filename)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+    def keys(self, period: str, include_errors: bool = False) -> set[tuple[str, str]]:
+        # (bank_name, filename) of the documents already done; failed LLM queries are asked again
+        query = 'SELECT bank_name, filename FROM results WHERE period=?'
+        if not include_errors:
+            query += " AND (source IS NULL OR source != 'error')"
+        with self.lock:
+            return set(self.conn.execute(query, (period,)).fetchall())
+
+
+    def hashes(self, period: str, include_errors: bool = False) -> dict[tuple[str, str], Optional[str]]:
+        # Same as keys(), with the sha256 of each document (None if unknown)
+        query = 'SELECT bank_name, filename, sha256 FROM results WHERE period=?'
+        if not include_errors:
+            query += " AND (source IS NULL OR source != 'error')"
+        with self.lock:
+            return {(bank_name, filename): sha256 for bank_name, filename, sha256 in self.conn.execute(query, (period,))}
+
+
+    def count(self, period: str) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM results WHERE period=?', (period,)).fetchone()[0]
+
+
+    def import_tsv(self, period: str, filename: Path) -> int:
+        '''Load the results of an older run (a {period}-data.tsv table); returns the number of rows'''
+        rows = read_tsv(filename)
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(period, row['bank_name'], row['filename'], row.get('source'), json.dumps(row, default=str), time.time(), None) for row in rows])
+        logger.info(f'Imported {len(rows)} results of period {period} from "{filename}"')
+        return len(rows)
+
+
+    def export_tsv(self, period: str, filename: Path) -> pd.DataFrame:
+        # Written to a temporary file first, so a crash never leaves a half-written table
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM results WHERE period=? ORDER BY bank_name, filename', (period,)).fetchall()
+        df = pd.DataFrame([json.loads(data) for data, in rows])
+        tmp_fn = filename.with_name(filename.name + '.tmp')
+        df.to_csv(tmp_fn, sep='\t', index=False)
+        tmp_fn.replace(filename)
+        return df
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_tsv(filename: Path) -> list[dict]:
+    # Rows of a {period}-data.tsv table, without the empty values
+    df = pd.read_csv(filename, sep='\t', dtype={'filename': str, 'bank_name': str})
+    return [{k: v for k, v in row.items() if not pd.isna(v)} for row in df.to_dict(orient='records')]
@@ -0,0 +1,91 @@
+'''
+Local lexical retrieval (BM25) over the paragraphs of a document
+
+Instead of sending the whole agreement to the LLM, build_context() keeps only the paragraphs that
+best match a few queries (one per field we extract), plus the first page (bank and product names
+are usually there). No embeddings or network calls needed.
+
+See: https://en.wikipedia.org/wiki/Okapi_BM25
+'''
+
+import math
+import re
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+
+import numpy as np
+
+from readers import Para
+
+
+re_token = re.compile(r'[a-z0-9]+')
+
+STOPWORDS = set('a an and are as at be by for from has have in is it its of on or that the this to was will with you your'.split())
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in re_token.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25:
+    '''Okapi BM25 index over a list of texts; scores are computed with NumPy, one query term at a time'''
+
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(texts)
+
+        # Inverted index: term -> (doc ids, term frequencies)
+        postings = defaultdict(lambda: ([], []))
+        doc_len = []
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings[term][0].append(i)
+                postings[term][1].append(tf)
+        self.postings = {term: (np.array(ids), np.array(tfs, dtype=float)) for term, (ids, tfs) in postings.items()}
+
+        doc_len = np.array(doc_len, dtype=float)
+        avg_len = doc_len.mean() if self.num_docs and doc_len.mean() > 0 else 1.0
+        self.norm = k1 * (1 - b + b * doc_len / avg_len) # per-document length normalization
+
+
+    def idf(self, term: str) -> float:
+        df = len(self.postings[term][0]) if term in self.postings else 0
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.num_docs)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            ids, tfs = self.postings[term]
+            scores[ids] += self.idf(term) * tfs * (self.k1 + 1) / (tfs + self.norm[ids])
+        return scores
+
+
+    def top_k(self, query: str, k: int) -> list[int]:
+        # Indices of the k best matches (only those matching at least one term), best first
+        scores = self.scores(query)
+        best = np.argsort(-scores, kind='stable')[:k]
+        return [int(i) for i in best if scores[i] > 0]
+
+
+def build_context(paras: list[Para], queries: Iterable[str], k: int = 5, first_page: bool = True) -> str:
+    '''
+    Concatenate the top-k paragraphs of each query (and all paragraphs of the first page), in document order
+    '''
+    if not paras:
+        return ''
+
+    index = BM25([para.text for para in paras])
+    selected = set()
+    if first_page:
+        page = paras[0].page
+        selected.update(i for i, para in enumerate(paras) if para.page == page)
+    for query in queries:
+        selected.update(index.top_k(query, k))
+
+    return '\n\n'.join(paras[i].text for i in sorted(selected))
@@ -0,0 +1,75 @@
+'''
+Run the documents of several periods as one job graph
+
+All periods share one Pipeline: one pool of parse workers, one LLM (so one rate limiter, circuit
+breaker and answer cache) and one bounded queue. Jobs are interleaved round-robin across periods,
+so a large period doesn't hold back the others, and each period is finalized (e.g. its TSV exported)
+as soon as its last document is done.
+'''
+
+from itertools import zip_longest
+from typing import Optional, Callable
+from dataclasses import dataclass, field
+
+from loguru import logger
+
+from pipeline import Pipeline, DocumentJob
+
+
+@dataclass
+class PeriodJobs:
+    period: str
+    jobs: list[DocumentJob]
+    prepare: Callable # see Pipeline.run()
+    finish: Callable
+    on_done: Optional[Callable] = None # Called with the list of results once all jobs of the period are done
+    results: dict = field(default_factory=dict) # job index -> result
+
+
+class Scheduler:
+
+    def __init__(self, pipeline: Pipeline):
+        self.pipeline = pipeline
+        self.periods = {} # period -> PeriodJobs
+
+
+    def add(self, period: str, jobs: list[DocumentJob], prepare: Callable, finish: Callable, on_done: Optional[Callable] = None):
+        assert period not in self.periods, f'Period {period} was already added'
+        assert all(job.period == period for job in jobs)
+        self.periods[period] = PeriodJobs(period, jobs, prepare, finish, on_done)
+
+
+    def run(self) -> dict[str, list]:
+        '''Returns the results of each period, in the order of its jobs'''
+        # Round-robin: first job of each period, then the second one, ...
+        positions = {} # id(job) -> index within its period
+        interleaved = []
+        for jobs in zip_longest(*(period_jobs.jobs for period_jobs in self.periods.values())):
+            for job in jobs:
+                if job is not None:
+                    interleaved.append(job)
+        for period_jobs in self.periods.values():
+            positions.update((id(job), i) for i, job in enumerate(period_jobs.jobs))
+            if not period_jobs.jobs:
+                self._done(period_jobs)
+        logger.info(f'Scheduling {len(interleaved)} documents of {len(self.periods)} periods')
+
+        def prepare(job: DocumentJob, paras):
+            return self.periods[job.period].prepare(job, paras)
+
+        def finish(job: DocumentJob, paras, ans):
+            period_jobs = self.periods[job.period]
+            result = period_jobs.finish(job, paras, ans)
+            period_jobs.results[positions[id(job)]] = result
+            if len(period_jobs.results) == len(period_jobs.jobs):
+                self._done(period_jobs)
+            return result
+
+        self.pipeline.run(interleaved, prepare, finish)
+        return {period: [period_jobs.results[i] for i in range(len(period_jobs.jobs))] for period, period_jobs in self.periods.items()}
+
+
+    def _done(self, period_jobs: PeriodJobs):
+        logger.info(f'Period {period_jobs.period} done ({len(period_jobs.jobs)} documents)')
+        if period_jobs.on_done is not None:
+            period_jobs.on_done([period_jobs.results[i] for i in range(len(period_jobs.jobs))])
@@ -0,0 +1,107 @@
+'''
+AnswerCache: lookups, group commits and eviction
+'''
+
+import sqlite3
+
+import pytest
+
+import cache
+from cache import AnswerCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Entry timestamps we control (eviction goes by them)
+    now = [1_000_000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    return now
+
+
+def count_rows(filename) -> int:
+    # What another process would see (only committed answers)
+    conn = sqlite3.connect(str(filename))
+    try:
+        return conn.execute('SELECT COUNT(*) FROM answers').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_get_first(tmp_path):
+    # Trying several keys is a single lookup: one hit or one miss
+    with AnswerCache(tmp_path / 'answers.sqlite') as answers:
+        answers.put('b', {'answer': 2})
+        answers.put('c', {'answer': 3})
+
+        assert answers.get_first(['a', 'b', 'c']) == ('b', {'answer': 2})
+        assert answers.stats['hits'] == 1 and answers.stats['misses'] == 0
+        assert answers.get_first(['x', 'y', 'z']) == (None, None)
+        assert answers.get_first([]) == (None, None)
+        assert answers.stats['hits'] == 1 and answers.stats['misses'] == 2
+
+        # "in" doesn't count
+        assert 'b' in answers and 'x' not in answers
+        assert answers.get('c') == {'answer': 3}
+        assert answers.stats['hits'] == 2 and answers.stats['misses'] == 2
+        assert answers.stats['hit_ratio'] == 0.5
+
+
+def test_group_commit(tmp_path):
+    # Answers are readable right away, but written every commit_every answers (or on close)
+    filename = tmp_path / 'answers.sqlite'
+    answers = AnswerCache(filename, commit_every=3, commit_interval=3600)
+    answers.put('a', {'answer': 1})
+    answers.put('b', {'answer': 2})
+    assert answers.get('a') == {'answer': 1}
+    assert count_rows(filename) == 0
+
+    answers.put('c', {'answer': 3})
+    assert count_rows(filename) == 3
+
+    answers.put('d', {'answer': 4})
+    assert count_rows(filename) == 3
+    answers.close()
+    assert count_rows(filename) == 4
+
+    with AnswerCache(filename) as answers:
+        assert [answers.get(key) for key in 'abcd'] == [{'answer': i} for i in range(1, 5)]
+
+
+def test_commit_interval(tmp_path):
+    filename = tmp_path / 'answers.sqlite'
+    with AnswerCache(filename, commit_every=100, commit_interval=0) as answers:
+        answers.put('a', {'answer': 1})
+        assert count_rows(filename) == 1
+
+
+def test_max_entries(tmp_path, clock):
+    # Above max_entries, the oldest answers go first
+    with AnswerCache(tmp_path / 'answers.sqlite', commit_every=1, max_entries=3) as answers:
+        for i in range(5):
+            clock[0] += 1
+            answers.put(f'key{i}', {'answer': i})
+
+        assert len(answers) == 3
+        assert [f'key{i}' in answers for i in range(5)] == [False, False, True, True, True]
+
+
+def test_max_age(tmp_path, clock):
+    # Expired answers are misses right away, and deleted on the next eviction
+    filename = tmp_path / 'answers.sqlite'
+    with AnswerCache(filename, max_age=100) as answers:
+        answers.put('old', {'answer': 1})
+        answers.commit()
+        clock[0] += 50
+        answers.put('new', {'answer': 2})
+        answers.commit()
+
+        clock[0] += 60
+        assert answers.get('old') is None
+        assert answers.get('new') == {'answer': 2}
+        assert answers.evict() == 1
+        assert len(answers) == 1
+
+    # Also when the cache is opened again
+    clock[0] += 100
+    with AnswerCache(filename, max_age=100) as answers:
+        assert len(answers) == 0
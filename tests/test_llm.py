@@ -0,0 +1,223 @@
+'''
+LLM client against the local stand-in server (fake_openai.py): no network, API key or costs
+'''
+
+import time
+
+import pytest
+
+import llm
+from llm import LLM, RateLimiter, CHEAP_MODEL, DEFAULT_MODEL, get_encoding_name, needs_escalation, truncate_context
+from utils import get_encoder
+from fake_openai import FakeOpenAI
+
+
+def make_requests(num_requests: int, prefix: str = 'doc') -> list[dict]:
+    return [dict(question='Q: ', context=f'{prefix} {i} ' * 50) for i in range(num_requests)]
+
+
+def test_concurrency(tmp_path):
+    # Many requests in flight at once, but never more than max_concurrency
+    with FakeOpenAI(latency=0.2) as fake:
+        model = LLM(base_url=fake.base_url, cache_filename=tmp_path / 'answers.sqlite', max_concurrency=8,
+                    rate_limiter=RateLimiter(rpm=6_000, tpm=10**9))
+        start = time.perf_counter()
+        answers = model.find_answers(make_requests(40))
+        elapsed = time.perf_counter() - start
+
+        # Second time around everything comes from the cache
+        cached = model.find_answers(make_requests(40))
+        model.close()
+
+    assert [ans['source'] for ans in answers] == ['llm'] * 40
+    assert [ans['source'] for ans in cached] == ['cache'] * 40
+    assert fake.num_requests == 40
+    assert 1 < fake.max_in_flight <= 8
+    assert elapsed < 40 * 0.2 / 2 # One at a time would take 8s
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rpm=60, tpm=10**9)
+    limiter.requests = 0 # Empty bucket: one request per second
+    start = time.perf_counter()
+    limiter.acquire(1)
+    limiter.acquire(1)
+    assert time.perf_counter() - start == pytest.approx(2, abs=0.3)
+
+
+def test_batch_round_trip(tmp_path):
+    # Batch answers end up in the cache, and nothing goes through the regular API
+    with FakeOpenAI(batch_polls=2) as fake:
+        model = LLM(base_url=fake.base_url, cache_filename=tmp_path / 'answers.sqlite')
+        requests = make_requests(25)
+        assert all(model.add_to_batch(**request) for request in requests)
+        assert not model.add_to_batch(**requests[0]) # Already queued
+        assert model.run_batch(tmp_path / 'batches', poll_interval=0.01, max_requests=10) == 25
+        answers = [model.get_batch_answer(**request) for request in requests]
+        assert not model.add_to_batch(**requests[0]) # Already cached
+        model.close()
+
+    assert [ans['source'] for ans in answers] == ['cache'] * 25
+    assert all(ans['bank_name'].startswith('Bank ') for ans in answers)
+    assert fake.num_requests == 0
+    assert len(fake.batches) == 3 # 10 + 10 + 5 requests
+    assert model.metrics.summary()['models'][model.model]['batch_calls'] == 25
+
+
+def test_failed_batch_is_not_resent(tmp_path, monkeypatch):
+    # Questions a failed batch didn't answer become error answers (asked again on the next run), not full price requests
+    monkeypatch.setattr(llm.OpenAIBatchTransport, 'status', lambda self, batch_id: ('failed', None))
+    with FakeOpenAI() as fake:
+        model = LLM(base_url=fake.base_url, cache_filename=tmp_path / 'answers.sqlite')
+        requests = make_requests(5)
+        for request in requests:
+            model.add_to_batch(**request)
+        assert model.run_batch(tmp_path / 'batches', poll_interval=0.01) == 0
+        answers = [model.get_batch_answer(**request) for request in requests]
+        model.close()
+
+    assert [(ans['source'], ans['error']) for ans in answers] == [('error', 'batch_missing')] * 5
+    assert fake.num_requests == 0
+
+
+def test_expired_batch_keeps_its_answers(tmp_path, monkeypatch):
+    # Expired/cancelled batches are billed for the requests they finished, so their output is stored too
+    status = llm.OpenAIBatchTransport.status
+    def expiring_status(self, batch_id):
+        batch_status, output_file_id = status(self, batch_id)
+        return ('expired', output_file_id) if batch_status == 'completed' else ('cancelling', None)
+    monkeypatch.setattr(llm.OpenAIBatchTransport, 'status', expiring_status)
+
+    with FakeOpenAI(batch_polls=2) as fake:
+        model = LLM(base_url=fake.base_url, cache_filename=tmp_path / 'answers.sqlite')
+        requests = make_requests(5)
+        for request in requests:
+            model.add_to_batch(**request)
+        assert model.run_batch(tmp_path / 'batches', poll_interval=0.01) == 5
+        answers = [model.get_batch_answer(**request) for request in requests]
+        model.close()
+
+    assert [ans['source'] for ans in answers] == ['cache'] * 5
+    assert fake.num_requests == 0
+    assert model.batch_requests == model.batch_content_keys == model.batch_metrics == {}
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm, 'BACKOFF_BASE', 0.01)
+
+
+def test_faults(tmp_path, fast_backoff):
+    # Injected 429/5xx errors are retried and truncated answers continued, without any exception
+    with FakeOpenAI(error_rate=0.3, truncate_rate=0.3, seed=1) as fake:
+        model = LLM(base_url=fake.base_url, cache_filename=tmp_path / 'answers.sqlite')
+        answers = model.find_answers(make_requests(40))
+        answers += [model.find_answer(**request) for request in make_requests(10, prefix='other')]
+        model.close()
+
+    assert all(ans['source'] == 'llm' and ans['bank_name'].startswith('Bank ') for ans in answers)
+    assert fake.num_errors > 0 and fake.num_truncated > 0
+    summary = model.metrics.summary()
+    assert summary['retries'] == fake.num_errors
+    assert summary['errors'] == {}
+
+
+def test_retries_are_counted(fast_backoff):
+    # max_retries=2: three attempts, of which two are retries
+    with FakeOpenAI(error_rate=1.0) as fake:
+        model = LLM(base_url=fake.base_url, max_retries=2)
+        ans = model.find_answer('Q: ', 'doc')
+
+    assert ans['source'] == 'error'
+    assert fake.num_requests == 3
+    assert model.metrics.summary()['retries'] == 2
+
+
+def test_outage(fast_backoff):
+    # The circuit breaker stops calling the API; every question gets an error answer
+    with FakeOpenAI(error_rate=1.0) as fake:
+        model = LLM(base_url=fake.base_url, max_retries=2, circuit_breaker=llm.CircuitBreaker(failure_threshold=5, reset_timeout=60))
+        answers = model.find_answers(make_requests(20))
+
+    assert {ans['source'] for ans in answers} == {'error'}
+    assert 'CircuitOpenError' in {ans['error'] for ans in answers}
+    assert fake.num_requests < 20
+
+
+@pytest.fixture(params=[CHEAP_MODEL, DEFAULT_MODEL])
+def encoding_name(request):
+    return get_encoding_name(request.param)
+
+
+def test_truncate_context(encoding_name):
+    # The most whole paragraphs that fit in max_tokens, counted with the model's own tokenizer
+    enc = get_encoder(encoding_name)
+    paras = [f'Section {i}. ' + 'The cardholder agrees to the terms of this agreement. ' * (i % 7 + 1) for i in range(40)]
+    context = '\n\n'.join(paras)
+    num_tokens = len(enc.encode_ordinary(context))
+    assert truncate_context(context, num_tokens, encoding_name) == context
+
+    for max_tokens in (num_tokens // 10, num_tokens // 3, num_tokens // 2, num_tokens - 1):
+        truncated = truncate_context(context, max_tokens, encoding_name)
+        assert len(enc.encode_ordinary(truncated)) <= max_tokens
+        keep = truncated.count('\n\n') + 1
+        assert truncated == '\n\n'.join(paras[:keep])
+        assert len(enc.encode_ordinary('\n\n'.join(paras[:keep + 1]))) > max_tokens
+
+
+def test_truncate_long_first_paragraph(encoding_name):
+    # A first paragraph longer than max_tokens is cut at the token level instead of leaving nothing
+    enc = get_encoder(encoding_name)
+    context = 'Gambling transactions are not permitted with this card. ' * 200 + '\n\nSecond paragraph.'
+    truncated = truncate_context(context, 100, encoding_name)
+    assert context.startswith(truncated)
+    assert 90 <= len(enc.encode_ordinary(truncated)) <= 100
+
+
+def test_truncate_multibyte(encoding_name):
+    # Cuts never split a character, nor go over the limit, whatever the characters' sizes in bytes and tokens
+    enc = get_encoder(encoding_name)
+    context = 'Cartão de crédito 信用卡协议 💳🎰 Kreditkartenvertrag für Glücksspiel ' * 30
+    for max_tokens in range(1, 80):
+        truncated = truncate_context(context, max_tokens, encoding_name)
+        assert context.startswith(truncated)
+        assert '\ufffd' not in truncated
+        assert len(enc.encode_ordinary(truncated)) <= max_tokens
+
+    # Within the byte-length shortcut's range: at most max_tokens bytes always fit
+    short = context[:20]
+    assert truncate_context(short, len(short.encode('utf-8')), encoding_name) == short
+
+
+CONTEXT = """Acme Bank Platinum Card Agreement (Visa)
+
+You may not use your card for illegal transactions, including
+online gambling, betting or wagering. We may decline any such transaction."""
+
+GOOD_ANSWER = dict(bank_name='Acme Bank', product_name='Platinum Card', card_network='Visa', gambling_prohibited='yes',
+                   gambling_snippet='You may not use your card for illegal transactions, including online gambling')
+
+
+@pytest.mark.parametrize('changes, reason', [
+    ({}, None),
+    ({'gambling_prohibited': 'Yes'}, None),
+    ({'gambling_prohibited': '', 'gambling_snippet': ''}, None),
+    ({'source': 'error'}, 'error'),
+    ({'card_network': None}, 'malformed'),
+    ({'gambling_prohibited': 'probably'}, 'malformed'),
+    ({field: '' for field in llm.ANSWER_FIELDS}, 'empty'),
+    ({'gambling_prohibited': ' Depends '}, 'depends'),
+    ({'gambling_snippet': 'Gambling is strictly prohibited'}, 'snippet_not_found'),
+    # Quotes span line breaks and may leave text out ("..." or "\u2026"), but every part must be in the context
+    ({'gambling_snippet': 'including online gambling, betting... We may decline any such transaction.'}, None),
+    ({'gambling_snippet': '"...online gambling\u2026 may decline..."'}, None),
+    ({'gambling_snippet': 'including online gambling... We never decline'}, 'snippet_not_found'),
+])
+def test_needs_escalation(changes, reason):
+    assert needs_escalation({**GOOD_ANSWER, **changes}, CONTEXT) == reason
+
+
+def test_needs_escalation_missing_field():
+    ans = dict(GOOD_ANSWER)
+    del ans['product_name']
+    assert needs_escalation(ans, CONTEXT) == 'malformed'
@@ -0,0 +1,16 @@
+'''
+LLMMetrics summaries
+'''
+
+from metrics import LLMMetrics
+
+
+def test_latency_histogram():
+    # A latency equal to a bucket's bound is counted in that bucket ("<=bound")
+    metrics = LLMMetrics()
+    assert metrics.summary()['models'] == {}
+    for latency in (0.1, 0.25, 0.3, 1, 64, 64.5, 1000):
+        metrics.record_call('gpt-4o-2024-05-13', 100, 10, latency=latency)
+
+    histogram = metrics.summary()['models']['gpt-4o-2024-05-13']['latency']['histogram']
+    assert histogram == {'<=0.25s': 2, '<=0.5s': 1, '<=1s': 1, '<=2s': 0, '<=4s': 0, '<=8s': 0, '<=16s': 0, '<=32s': 0, '<=64s': 1, '>64s': 2}
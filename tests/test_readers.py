@@ -0,0 +1,125 @@
+'''
+The optimized parsing helpers must give the same output as the code they replaced (copied here as legacy_*)
+'''
+
+import re
+import random
+from functools import partial
+
+import pytest
+import pdfplumber
+
+from readers import table_to_markdown, clean_text, text2paragraphs, exclude_bboxes
+from bench import make_synthetic_pdf
+
+
+def legacy_table_to_markdown(table):
+    # PDF.yield_paragraphs() before table_to_markdown()
+    pd = pytest.importorskip('pandas')
+    markdown_table = pytest.importorskip('py_markdown_table.markdown_table').markdown_table
+    table = [['' if c is None else c.replace('\n', ' ').strip() for c in row] for row in table]
+    df = pd.DataFrame(table)
+    empty_cols = [df[col].name for col in df if not df[col].any()]
+    df.drop(empty_cols, axis=1, inplace=True)
+    df.rename(columns = {x: "C"+str(x+1) for x in range(0,240)}, inplace = True)
+    data = df.to_dict(orient='records')
+    if not data:
+        return None
+    try:
+        md_table = markdown_table(data).set_params(row_sep='markdown', quote=False)
+        md = md_table.get_markdown()
+        md = md.split('\n')
+        md = [md[2], md[1]] + md[3:]
+        return '\n'.join(md)
+    except:
+        return markdown_table(data).get_markdown()
+
+
+def test_table_to_markdown():
+    rng = random.Random(0)
+    cells = [None, '', 'a', 'ab', 'Annual Fee', '$0', 'x\ny', ' pad ', '12.5%', 'longer cell text here', 'é']
+    for _ in range(3_000):
+        num_rows, num_cols = rng.randint(1, 4), rng.randint(1, 5)
+        table = [[rng.choice(cells) for _ in range(num_cols)] for _ in range(num_rows)]
+        assert table_to_markdown(table) == legacy_table_to_markdown(table), table
+
+
+def legacy_clean_text(text: str) -> str:
+    text = text.replace(u'\u201f', '"')  # double high-reversed-9 quotation mark
+    text = text.replace(u'\u201c', '"')  # left double quotation mark
+    text = text.replace(u'\u201d', '"')  # right double quotation mark
+    text = text.replace(u'\u2019', "'")
+    text = re.sub(r'(\(cid:\d+\)){2,}', "", text)  # Bullet symbol
+    text = re.sub(r'\s\(cid:\d+\) ', "- ", text)  # The number could be 1, 2, 130, 190, 216, etc.
+    return text
+
+
+def legacy_text2paragraphs(text: str) -> list[str]:
+    paras = []
+    lines = [legacy_fix_line(line) for line in text.split('\n')] + ['']
+    parts = []
+    for line in lines:
+        if not line and parts:
+            new_para = ' '.join(parts)
+            if '\uf0b7' in new_para:
+                new_para = legacy_fix_bullet_list(new_para)
+            paras.append(new_para)
+            parts = []
+        elif line:
+            parts.append(line)
+    if paras and paras[-1].isdigit():
+        paras = paras[:-1]
+    return paras
+
+
+def legacy_fix_line(text: str) -> str:
+    text = text.strip()
+    text = re.sub(r'\s{2,}', ' ', text)
+    text = text.replace('\u201d', '"').replace('\u201c', '"')
+    return text
+
+
+def legacy_fix_bullet_list(text: str) -> str:
+    items = text.split('\uf0b7')
+    items = [item.strip() for item in items]
+    items = ['- ' + item for item in items if item]
+    return '\n'.join(items)
+
+
+def test_text_normalization():
+    # Random pages made of the pieces that matter: whitespace of all kinds (incl. the ones str.split()
+    # treats as line breaks), page breaks, curly quotes, (cid:N) glyphs, bullets and page numbers
+    rng = random.Random(3)
+    pieces = ['word', 'Fee', ' ', '  ', '\n', '\n\n', '\n \n', '\t', '\x0c', '\x0b', '\r', '\xa0', '\x1c', '\x85', '\u2028',
+              '\u201c', '\u201d', '\u201f', '\u2019', '(cid:12)', ' (cid:3) ', '', '12', '7', '.', '\uf0b7', ' \uf0b7 ']
+    for _ in range(50_000):
+        text = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+        assert clean_text(text) == legacy_clean_text(text), repr(text)
+        assert list(text2paragraphs(clean_text(text))) == legacy_text2paragraphs(legacy_clean_text(text)), repr(text)
+
+
+def legacy_not_within_bboxes(obj, bboxes):
+    # Filter for page.filter(); True if the object's midpoint is outside all bboxes
+    def obj_in_bbox(_bbox):
+        v_mid = (obj["top"] + obj["bottom"]) / 2
+        h_mid = (obj["x0"] + obj["x1"]) / 2
+        x0, top, x1, bottom = _bbox
+        return (h_mid >= x0) and (h_mid < x1) and (v_mid >= top) and (v_mid < bottom)
+
+    return not any(obj_in_bbox(__bbox) for __bbox in bboxes)
+
+
+def test_exclude_bboxes(tmp_path):
+    # 30 pages x 3 random sets of 1-5 "table" bboxes
+    pdf_fn = tmp_path / 'synthetic.pdf'
+    make_synthetic_pdf(pdf_fn, num_pages=30)
+    rng = random.Random(0)
+    with pdfplumber.open(pdf_fn) as pdf:
+        for page in pdf.pages:
+            for _ in range(3):
+                bboxes = []
+                for _ in range(rng.randint(1, 5)):
+                    x0, top = rng.uniform(0, 500), rng.uniform(0, 700)
+                    bboxes.append((x0, top, x0 + rng.uniform(10, 300), top + rng.uniform(10, 200)))
+                expected = page.filter(partial(legacy_not_within_bboxes, bboxes=bboxes)).extract_text(layout=True, y_density=13.8)
+                assert exclude_bboxes(page, bboxes).extract_text(layout=True, y_density=13.8) == expected, (page.page_number, bboxes)
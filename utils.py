@@ -2,7 +2,20 @@
 Common functions
 '''
 
+import os
 import re
+import hashlib
+from functools import cache
+from pathlib import Path
+from typing import Optional
+
+import tiktoken
+
+# Optional; only needed to measure memory outside Linux
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 re_text_only = re.compile(r'[^a-z0-9 .-]')
 
@@ -13,3 +26,32 @@ def normalize_text_for_embedding(text: str) -> str:
     text = re_text_only.sub('', text)
     return text
 
+
+def file_sha256(filename: Path) -> str:
+    # Hash the file contents in chunks (PDFs can be large)
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@cache
+def get_encoder(encoding_name: str = 'cl100k_base') -> tiktoken.Encoding:
+    # Loading the encoding is slow, so only do it once per process
+    return tiktoken.get_encoding(encoding_name)
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoder().encode_ordinary(text))
+
+
+def get_rss_mb() -> Optional[float]:
+    # Current resident set size of this process in MB (None if we can't measure it)
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None